@@ -1,8 +1,15 @@
 import csv
+import json
+import mmap
+import multiprocessing
+import os
+import struct
 import sys
 import time
+from array import array
+from collections import OrderedDict
 
-from util import Node, StackFrontier, QueueFrontier
+from util import Node, StackFrontier, QueueFrontier, BipartiteGraph
 
 # Maps names to a set of corresponding person_ids
 names = {}
@@ -13,11 +20,60 @@ people = {}
 # Maps movie_ids to a dictionary of: title, year, stars (a set of person_ids)
 movies = {}
 
+# In compact mode, a BipartiteGraph of people and movies; people and movies
+# then hold only names, births, titles and years, without the sets
+graph = None
 
-def load_data(directory):
+# Binary snapshot of the loaded data, written next to the CSV files.
+# The header holds a magic string, the format version, whether it was
+# written on a little-endian machine, the (mtime, size) of each CSV file,
+# and the (offset, length) of each section in the file.
+SNAPSHOT = "degrees.snapshot"
+SNAPSHOT_MAGIC = b"DEGREES\0"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILES = ["people.csv", "movies.csv", "stars.csv"]
+SNAPSHOT_SECTIONS = 10
+SNAPSHOT_HEADER = struct.Struct(
+    f"<8sII{2 * len(SNAPSHOT_FILES)}q{2 * SNAPSHOT_SECTIONS}q"
+)
+
+# Counters from the most recent search
+stats = {"expanded": 0}
+
+# Maps a source person_id to the (distance, parent) found by single_source,
+# for the TREES most recently used sources (each covers every person
+# reachable from its source)
+TREES = 4
+source_trees = OrderedDict()
+
+
+def load_data(directory, compact=False, snapshot=True):
     """
     Load data from CSV files into memory.
+
+    If `compact` is true, the star/movie links are stored as an
+    integer-indexed `graph` instead of sets of ids.
+
+    If `snapshot` is true, the data is read from the binary snapshot in
+    `directory` when it is up to date with the CSV files, and otherwise
+    loaded from the CSV files and written to a new snapshot.
     """
+    source_trees.clear()
+
+    if snapshot:
+        if not read_snapshot(directory):
+            load_compact(directory)
+            write_snapshot(directory)
+        if not compact:
+            expand_graph()
+        return
+
+    if compact:
+        return load_compact(directory)
+
+    global graph
+    graph = None
+
     # Load people
     with open(f"{directory}/people.csv", encoding="utf-8") as f:
         reader = csv.DictReader(f)
@@ -53,25 +109,248 @@ def load_data(directory):
                 pass
 
 
+def load_compact(directory):
+    """
+    Load data from CSV files into memory, storing the star/movie links
+    as a BipartiteGraph over dense person and movie indexes.
+    """
+    global graph
+
+    person_ids = []
+    with open(f"{directory}/people.csv", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            person_ids.append(row["id"])
+            people[row["id"]] = {
+                "name": row["name"],
+                "birth": row["birth"]
+            }
+            names.setdefault(row["name"].lower(), set()).add(row["id"])
+
+    movie_ids = []
+    with open(f"{directory}/movies.csv", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            movie_ids.append(row["id"])
+            movies[row["id"]] = {
+                "title": row["title"],
+                "year": row["year"]
+            }
+
+    person_index = {person_id: i for i, person_id in enumerate(person_ids)}
+    movie_index = {movie_id: i for i, movie_id in enumerate(movie_ids)}
+    edge_people = array("i")
+    edge_movies = array("i")
+    with open(f"{directory}/stars.csv", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                person = person_index[row["person_id"]]
+                movie = movie_index[row["movie_id"]]
+            except KeyError:
+                continue
+            edge_people.append(person)
+            edge_movies.append(movie)
+
+    graph = BipartiteGraph.from_edges(
+        person_ids, movie_ids, edge_people, edge_movies, person_index
+    )
+
+
+def expand_graph():
+    """
+    Replace the compact `graph` with the sets of movie_ids and person_ids
+    in `people` and `movies`.
+    """
+    global graph
+
+    for person_id in graph.person_ids:
+        people[person_id]["movies"] = set()
+    for movie, movie_id in enumerate(graph.movie_ids):
+        stars = set()
+        for i in range(graph.movie_offsets[movie],
+                       graph.movie_offsets[movie + 1]):
+            person_id = graph.person_ids[graph.movie_stars[i]]
+            stars.add(person_id)
+            people[person_id]["movies"].add(movie_id)
+        movies[movie_id]["stars"] = stars
+    graph = None
+
+
+def snapshot_fingerprint(directory):
+    """
+    Returns the (mtime, size) of each CSV file, flattened into a tuple.
+    """
+    fingerprint = []
+    for filename in SNAPSHOT_FILES:
+        stat = os.stat(os.path.join(directory, filename))
+        fingerprint.extend([stat.st_mtime_ns, stat.st_size])
+    return tuple(fingerprint)
+
+
+def write_snapshot(directory):
+    """
+    Write the compact data to the snapshot file in `directory`.
+    Failing to write it (e.g. to a read-only directory) is not an error.
+    """
+    columns = [
+        graph.person_ids,
+        [people[person_id]["name"] for person_id in graph.person_ids],
+        [people[person_id]["birth"] for person_id in graph.person_ids],
+        graph.movie_ids,
+        [movies[movie_id]["title"] for movie_id in graph.movie_ids],
+        [movies[movie_id]["year"] for movie_id in graph.movie_ids]
+    ]
+    arrays = [
+        graph.person_offsets, graph.person_movies,
+        graph.movie_offsets, graph.movie_stars
+    ]
+    sections = [
+        "\0".join(column).encode("utf-8") for column in columns
+    ] + [bytes(values) for values in arrays]
+
+    # Lay sections out after the header, each aligned to 8 bytes
+    table = []
+    offset = SNAPSHOT_HEADER.size
+    for section in sections:
+        offset += -offset % 8
+        table.extend([offset, len(section)])
+        offset += len(section)
+
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.byteorder == "little",
+        *snapshot_fingerprint(directory), *table
+    )
+    path = os.path.join(directory, SNAPSHOT)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            for section, start in zip(sections, table[::2]):
+                f.write(bytes(start - f.tell()))
+                f.write(section)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def read_snapshot(directory):
+    """
+    Load data from the snapshot file in `directory`, memory-mapping the
+    graph arrays. Returns False if there is no usable, up-to-date snapshot.
+    """
+    global graph
+
+    try:
+        with open(os.path.join(directory, SNAPSHOT), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+
+    if len(data) < SNAPSHOT_HEADER.size:
+        data.close()
+        return False
+    magic, version, little, *fields = SNAPSHOT_HEADER.unpack_from(data)
+    fingerprint = tuple(fields[:2 * len(SNAPSHOT_FILES)])
+    table = fields[2 * len(SNAPSHOT_FILES):]
+    if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION
+            or little != (sys.byteorder == "little")
+            or fingerprint != snapshot_fingerprint(directory)):
+        data.close()
+        return False
+
+    view = memoryview(data)
+    sections = [
+        view[start:start + length]
+        for start, length in zip(table[::2], table[1::2])
+    ]
+    arrays = [section.cast("i") for section in sections[6:]]
+
+    # Rows per column come from the offsets arrays, since a single empty
+    # value and no values at all are both an empty section
+    rows = [len(arrays[0]) - 1] * 3 + [len(arrays[2]) - 1] * 3
+    columns = [
+        str(section, "utf-8").split("\0") if count else []
+        for section, count in zip(sections[:6], rows)
+    ]
+    if [len(column) for column in columns] != rows:
+        data.close()
+        return False
+    person_ids, person_names, births, movie_ids, titles, years = columns
+
+    for person_id, name, birth in zip(person_ids, person_names, births):
+        people[person_id] = {
+            "name": name,
+            "birth": birth
+        }
+        names.setdefault(name.lower(), set()).add(person_id)
+    for movie_id, title, year in zip(movie_ids, titles, years):
+        movies[movie_id] = {
+            "title": title,
+            "year": year
+        }
+
+    # The graph arrays stay in the mapped file rather than being copied
+    graph = BipartiteGraph(person_ids, movie_ids, *arrays)
+    return True
+
+
 def main():
 
-    if len(sys.argv) > 2:
-        sys.exit("Usage: python degrees.py [directory]")
-    directory = sys.argv[1] if len(sys.argv) == 2 else "large"
+    flags = {}
+    args = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            flag, _, value = arg.partition("=")
+            flags[flag] = value
+        else:
+            args.append(arg)
+    if len(args) > 1 or any(
+        flag not in ("--bidirectional", "--compact", "--batch",
+                     "--distribution")
+        for flag in flags
+    ):
+        sys.exit("Usage: python degrees.py [--bidirectional] [--compact] "
+                 "[--batch[=pairs.csv] | --distribution] [directory]")
+    directory = args[0] if args else "large"
+    compact = "--compact" in flags
+    bidirectional = "--bidirectional" in flags
+
+    if "--batch" in flags:
+        # Keep stdout for the results
+        print("Loading data...", file=sys.stderr)
+        load_data(directory, compact=compact)
+        print("Data loaded.", file=sys.stderr)
+        if flags["--batch"]:
+            with open(flags["--batch"], encoding="utf-8") as f:
+                run_batch(f, directory, compact, bidirectional)
+        else:
+            run_batch(sys.stdin, directory, compact, bidirectional)
+        return
 
     # Load data from files into memory
     print("Loading data...")
-    load_data(directory)
+    load_data(directory, compact=compact)
     print("Data loaded.")
 
     source = person_id_for_name(input("Name: "))
     if source is None:
         sys.exit("Person not found.")
+
+    if "--distribution" in flags:
+        distance, _ = single_source(source)
+        counts = {}
+        for degrees in distance.values():
+            counts[degrees] = counts.get(degrees, 0) + 1
+        for degrees in sorted(counts):
+            print(f"{degrees} degrees of separation: {counts[degrees]} people")
+        return
+
     target = person_id_for_name(input("Name: "))
     if target is None:
         sys.exit("Person not found.")
 
-    path = shortest_path(source, target)
+    path = shortest_path(source, target, bidirectional=bidirectional)
+    print(f"{stats['expanded']} nodes expanded.")
 
     if path is None:
         print("Not connected.")
@@ -86,22 +365,214 @@ def main():
             print(f"{i + 1}: {person1} and {person2} starred in {movie}")
 
 
-def shortest_path(source, target):
+def run_batch(lines, directory, compact=False, bidirectional=False,
+              processes=None):
+    """
+    Answer every (source, target) pair of names in `lines`, given as CSV
+    rows, and write one JSON object per pair to stdout in input order.
+
+    The data must already be loaded; worker processes share it
+    copy-on-write where the platform can fork, and otherwise load it
+    again (from the snapshot) themselves.
+    """
+    pairs = ((row, bidirectional) for row in csv.reader(lines) if row)
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        initializer, initargs = None, ()
+    else:
+        context = multiprocessing.get_context()
+        initializer, initargs = load_data, (directory, compact)
+
+    with context.Pool(processes, initializer, initargs) as pool:
+        for result in pool.imap(answer_pair, pairs, chunksize=16):
+            print(json.dumps(result), flush=True)
+
+
+def answer_pair(job):
+    """
+    Returns a dictionary describing the shortest path between the
+    two people named in a batch row, or the reason there is none.
+    """
+    row, bidirectional = job
+    if len(row) != 2:
+        return {"row": row, "error": "Expected a source and a target."}
+    result = {"source": row[0], "target": row[1]}
+
+    ids = []
+    for name in row:
+        person_ids = person_ids_for_name(name)
+        if len(person_ids) != 1:
+            result["error"] = (
+                f"Person not found: {name}" if not person_ids else
+                f"Which '{name}'? IDs: {', '.join(sorted(person_ids))}"
+            )
+            return result
+        ids.append(person_ids[0])
+
+    path = shortest_path(ids[0], ids[1], bidirectional=bidirectional)
+    result["degrees"] = None if path is None else len(path)
+    result["path"] = None if path is None else [
+        {
+            "movie_id": movie_id,
+            "title": movies[movie_id]["title"],
+            "person_id": person_id,
+            "name": people[person_id]["name"]
+        }
+        for movie_id, person_id in path
+    ]
+    return result
+
+
+def shortest_path(source, target, bidirectional=False):
     """
     Returns the shortest list of (movie_id, person_id) pairs
     that connect the source to the target.
 
     If no possible path, returns None.
+
+    If `bidirectional` is true, searches from both ends at once.
+    The number of nodes expanded is recorded in `stats`.
+
+    If single_source has already been run from the source or the target,
+    the path is read from its cached result instead.
+    """
+    if source in source_trees:
+        stats["expanded"] = 0
+        source_trees.move_to_end(source)
+        return tree_path(source_trees[source], target)
+    if target in source_trees:
+        stats["expanded"] = 0
+        source_trees.move_to_end(target)
+        return reverse_path(target, tree_path(source_trees[target], source))
+
+    search = bidirectional_path if bidirectional else breadth_first_path
+    if graph is None:
+        return search(source, target, neighbors_for_person)
+
+    # Search over graph indexes, mapping back to ids only for the result
+    path = search(
+        graph.person_index[source], graph.person_index[target],
+        graph.neighbors
+    )
+    if path is None:
+        return None
+    return [
+        (graph.movie_ids[movie], graph.person_ids[person])
+        for movie, person in path
+    ]
+
+
+def single_source(source):
+    """
+    Returns (distance, parent) for every person reachable from source,
+    found by a single breadth-first search: distance maps each person_id
+    to its degrees of separation, and parent maps each person_id other
+    than the source to the (movie_id, person_id) one step closer to it.
+
+    Results are cached for the TREES most recently used sources, and
+    shortest_path uses them.
+    """
+    if source in source_trees:
+        source_trees.move_to_end(source)
+        return source_trees[source]
+
+    if graph is None:
+        distance, parent = breadth_first_tree(source, neighbors_for_person)
+    else:
+        indexed_distance, indexed_parent = breadth_first_tree(
+            graph.person_index[source], graph.neighbors
+        )
+        person_ids, movie_ids = graph.person_ids, graph.movie_ids
+        distance = {
+            person_ids[person]: degrees
+            for person, degrees in indexed_distance.items()
+        }
+        parent = {
+            person_ids[person]: (movie_ids[movie], person_ids[previous])
+            for person, (movie, previous) in indexed_parent.items()
+        }
+
+    source_trees[source] = (distance, parent)
+    while len(source_trees) > TREES:
+        source_trees.popitem(last=False)
+    return source_trees[source]
+
+
+def breadth_first_tree(source, neighbors):
+    """
+    Returns (distance, parent) dictionaries for a breadth-first search
+    from source over the whole graph; see single_source.
+    """
+    distance = {source: 0}
+    parent = {}
+    layer = [source]
+    degrees = 0
+    stats["expanded"] = 0
+
+    while layer:
+        degrees += 1
+        next_layer = []
+        for person in layer:
+            stats["expanded"] += 1
+            for movie, neighbor in neighbors(person):
+                if neighbor not in distance:
+                    distance[neighbor] = degrees
+                    parent[neighbor] = (movie, person)
+                    next_layer.append(neighbor)
+        layer = next_layer
+
+    return distance, parent
+
+
+def tree_path(tree, target):
+    """
+    Returns the (movie_id, person_id) pairs leading to target in a
+    single_source (distance, parent) result, or None if it was not reached.
+    """
+    distance, parent = tree
+    if target not in distance:
+        return None
+    path = []
+    while target in parent:
+        movie_id, previous = parent[target]
+        path.append((movie_id, target))
+        target = previous
+    path.reverse()
+    return path
+
+
+def reverse_path(start, path):
+    """
+    Reverses a list of (movie_id, person_id) pairs leading from `start`,
+    so that it leads back to `start` from the last person on the path.
+    """
+    if path is None:
+        return None
+    person_ids = [start] + [person_id for _, person_id in path]
+    return [
+        (path[i][0], person_ids[i]) for i in reversed(range(len(path)))
+    ]
+
+
+def breadth_first_path(source, target, neighbors):
     """
+    Returns the shortest list of (movie, person) pairs that connect
+    the source to the target using breadth-first search, where
+    `neighbors(person)` yields the (movie, person) pairs next to a person.
 
+    If no possible path, returns None.
+    """
     noOfExlporedPath = 0
+    stats["expanded"] = 0
+
+    if source == target:
+        return []
 
     start = Node(state=source,parent=None,action=None)
     frontier = QueueFrontier()
     frontier.add(start)
 
-    explored = set()
-    noOfNodes = 1
+    explored = {source}
 
     while True:
         if frontier.empty():
@@ -110,25 +581,119 @@ def shortest_path(source, target):
         node = frontier.remove()
         
         noOfExlporedPath += 1
+        stats["expanded"] = noOfExlporedPath
 
-        explored.add(node.state)
-
-        neighbours = neighbors_for_person(node.state)
-
-        for action,state in neighbours:
-            if node.state == target:
-                actions = []
+        #test each neighbour as it is generated, so the search stops
+        #as soon as the target is reached
+        for action,state in neighbors(node.state):
+            if state == target:
+                actions = [(action,state)]
                 while node.parent is not None:
                     actions.append((node.action,node.state))
                     node = node.parent
                 actions.reverse()
                 return actions
 
-            elif state not in explored and not frontier.contains_state(state):
+            elif state not in explored:
+                explored.add(state)
                 child = Node(state=state,parent=node,action=action)
                 frontier.add(child)
-                noOfNodes += 1
-  
+
+
+def bidirectional_path(source, target, neighbors):
+    """
+    Returns the shortest list of (movie, person) pairs
+    that connect the source to the target, growing one breadth-first
+    search from each end and stopping when they meet.
+
+    If no possible path, returns None.
+    """
+    stats["expanded"] = 0
+    if source == target:
+        return []
+
+    # Maps each reached person to (movie, person) one step
+    # closer to the source (or target) of its search
+    forward = {source: None}
+    backward = {target: None}
+    forward_layer = [source]
+    backward_layer = [target]
+
+    while forward_layer and backward_layer:
+
+        # Expand a whole layer of the smaller side
+        if len(forward_layer) <= len(backward_layer):
+            reached, other, layer = forward, backward, forward_layer
+        else:
+            reached, other, layer = backward, forward, backward_layer
+
+        best = None
+        next_layer = []
+        for person in layer:
+            stats["expanded"] += 1
+            for movie, neighbor in neighbors(person):
+                if neighbor in reached:
+                    continue
+                reached[neighbor] = (movie, person)
+                next_layer.append(neighbor)
+                if neighbor in other:
+                    length = (depth(reached, neighbor)
+                              + depth(other, neighbor))
+                    if best is None or length < best[0]:
+                        best = (length, neighbor)
+
+        # Every meeting found in this layer is no longer than any later one
+        if best is not None:
+            return join_paths(forward, backward, best[1])
+
+        if reached is forward:
+            forward_layer = next_layer
+        else:
+            backward_layer = next_layer
+
+    return None
+
+
+def depth(reached, person):
+    """
+    Returns the number of steps from person to the root of its search.
+    """
+    steps = 0
+    while reached[person] is not None:
+        person = reached[person][1]
+        steps += 1
+    return steps
+
+
+def join_paths(forward, backward, meeting):
+    """
+    Returns the (movie, person) pairs from the source of `forward`
+    through `meeting` to the target of `backward`.
+    """
+    path = []
+    person = meeting
+    while forward[person] is not None:
+        movie, parent = forward[person]
+        path.append((movie, person))
+        person = parent
+    path.reverse()
+
+    person = meeting
+    while backward[person] is not None:
+        movie, person = backward[person]
+        path.append((movie, person))
+    return path
+
+
+def person_ids_for_name(name):
+    """
+    Returns the list of IMDB ids matching a person's name,
+    or a list of just `name` if it is itself an id.
+    """
+    if name in people:
+        return [name]
+    return list(names.get(name.lower(), set()))
+
 
 def person_id_for_name(name):
     """
@@ -158,15 +723,20 @@ def person_id_for_name(name):
 
 def neighbors_for_person(person_id):
     """
-    Returns (movie_id, person_id) pairs for people
+    Yields (movie_id, person_id) pairs for people
     who starred with a given person.
+
+    Pairs are generated lazily, so a caller that stops iterating
+    (e.g. once it finds its target) does no further work.
     """
-    movie_ids = people[person_id]["movies"]
-    neighbors = set()
-    for movie_id in movie_ids:
+    if graph is not None:
+        for movie, person in graph.neighbors(graph.person_index[person_id]):
+            yield (graph.movie_ids[movie], graph.person_ids[person])
+        return
+
+    for movie_id in people[person_id]["movies"]:
         for person_id in movies[movie_id]["stars"]:
-            neighbors.add((movie_id, person_id))
-    return neighbors
+            yield (movie_id, person_id)
 
 
 if __name__ == "__main__":
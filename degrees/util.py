@@ -1,3 +1,7 @@
+from array import array
+from collections import deque
+
+
 class Node():
     def __init__(self, state, parent, action):
         self.state = state
@@ -7,13 +11,17 @@ class Node():
 
 class StackFrontier():
     def __init__(self):
-        self.frontier = []
+        self.frontier = deque()
+
+        # Number of nodes in the frontier for each state
+        self.states = {}
 
     def add(self, node):
         self.frontier.append(node)
+        self.states[node.state] = self.states.get(node.state, 0) + 1
 
     def contains_state(self, state):
-        return any(node.state == state for node in self.frontier)
+        return state in self.states
 
     def empty(self):
         return len(self.frontier) == 0
@@ -22,10 +30,17 @@ class StackFrontier():
         if self.empty():
             raise Exception("empty frontier")
         else:
-            node = self.frontier[-1]
-            self.frontier = self.frontier[:-1]
+            node = self.frontier.pop()
+            self.discard(node)
             return node
 
+    def discard(self, node):
+        count = self.states[node.state] - 1
+        if count:
+            self.states[node.state] = count
+        else:
+            del self.states[node.state]
+
 
 class QueueFrontier(StackFrontier):
 
@@ -33,6 +48,76 @@ class QueueFrontier(StackFrontier):
         if self.empty():
             raise Exception("empty frontier")
         else:
-            node = self.frontier[0]
-            self.frontier = self.frontier[1:]
+            node = self.frontier.popleft()
+            self.discard(node)
             return node
+
+
+class BipartiteGraph():
+    """
+    Graph between people and the movies they starred in, with both
+    numbered densely from 0 and adjacency stored as CSR arrays: the movies
+    of person i are person_movies[person_offsets[i]:person_offsets[i + 1]],
+    and likewise movie_offsets and movie_stars give the stars of a movie.
+    """
+
+    def __init__(self, person_ids, movie_ids, person_offsets, person_movies,
+                 movie_offsets, movie_stars, person_index=None):
+        self.person_ids = person_ids
+        self.movie_ids = movie_ids
+        self.person_offsets = person_offsets
+        self.person_movies = person_movies
+        self.movie_offsets = movie_offsets
+        self.movie_stars = movie_stars
+        if person_index is None:
+            person_index = {
+                person_id: i for i, person_id in enumerate(person_ids)
+            }
+        self.person_index = person_index
+
+    @classmethod
+    def from_edges(cls, person_ids, movie_ids, edge_people, edge_movies,
+                   person_index=None):
+        """
+        Builds the graph from parallel arrays of (person, movie) indexes.
+        """
+        person_offsets, person_movies = csr(
+            len(person_ids), edge_people, edge_movies
+        )
+        movie_offsets, movie_stars = csr(
+            len(movie_ids), edge_movies, edge_people
+        )
+        return cls(person_ids, movie_ids, person_offsets, person_movies,
+                   movie_offsets, movie_stars, person_index)
+
+    def neighbors(self, person):
+        """
+        Yields (movie, person) index pairs for people
+        who starred with a given person.
+        """
+        person_offsets, person_movies = self.person_offsets, self.person_movies
+        movie_offsets, movie_stars = self.movie_offsets, self.movie_stars
+        for i in range(person_offsets[person], person_offsets[person + 1]):
+            movie = person_movies[i]
+            for j in range(movie_offsets[movie], movie_offsets[movie + 1]):
+                yield (movie, movie_stars[j])
+
+
+def csr(size, rows, columns):
+    """
+    Groups the parallel arrays `rows` and `columns` by row, where every row
+    is below `size`, and returns (offsets, indices) arrays in CSR form.
+    """
+    offsets = array("i", [0]) * (size + 1)
+    for row in rows:
+        offsets[row + 1] += 1
+    for i in range(size):
+        offsets[i + 1] += offsets[i]
+
+    # Fill each row from its start, using a copy of offsets as cursors
+    cursor = array("i", offsets)
+    indices = array("i", [0]) * len(rows)
+    for row, column in zip(rows, columns):
+        indices[cursor[row]] = column
+        cursor[row] += 1
+    return offsets, indices
@@ -1,6 +1,13 @@
 import csv
+import heapq
 import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
 import sys
+import numpy
 
 PROBS = {
 
@@ -37,14 +44,117 @@ PROBS = {
 }
 
 
+def inheritance_table(probs):
+    """
+    Return table[mother][father][child]: the probability that a child has
+    `child` copies of the gene, given how many copies each parent has.
+    """
+    # Probability of passing the gene on, for each number of copies
+    passes = [
+        probs["mutation"],
+        0.5,
+        1 - probs["mutation"]
+    ]
+    table = [[[0] * 3 for _ in range(3)] for _ in range(3)]
+    for mother in range(3):
+        for father in range(3):
+            from_mother = passes[mother]
+            from_father = passes[father]
+            table[mother][father][2] = from_mother * from_father
+            table[mother][father][1] = (from_mother * (1 - from_father)
+                                        + (1 - from_mother) * from_father)
+            table[mother][father][0] = (1 - from_mother) * (1 - from_father)
+    return table
+
+
+# Tables computed once from PROBS, indexed by number of copies of the gene:
+# GENE[genes] for people without known parents,
+# INHERITANCE[mother][father][child] for people with them,
+# and TRAIT[genes][trait] with the trait as False/True (or 0/1)
+GENE = [PROBS["gene"][genes] for genes in range(3)]
+INHERITANCE = inheritance_table(PROBS)
+TRAIT = [
+    [PROBS["trait"][genes][False], PROBS["trait"][genes][True]]
+    for genes in range(3)
+]
+
+
+def log_table(table):
+    """
+    Return a copy of a (nested) list of probabilities with each replaced
+    by its natural logarithm, or -inf for a probability of 0.
+    """
+    if isinstance(table, list):
+        return [log_table(entry) for entry in table]
+    return math.log(table) if table > 0 else -math.inf
+
+
+# The same tables as logarithms
+LOG_GENE = log_table(GENE)
+LOG_INHERITANCE = log_table(INHERITANCE)
+LOG_TRAIT = log_table(TRAIT)
+
+# Largest number of joint probabilities vectorized_probabilities
+# evaluates at once
+CHUNK = 1 << 20
+
+# Defaults for sample_probabilities: samples per chain in each round,
+# number of chains, and Gibbs sweeps discarded at the start of each chain
+SAMPLES = 10000
+CHAINS = 4
+BURN_IN = 100
+
+# Default limit on the samples drawn in all by sample_probabilities when
+# sampling until an error is reached
+MAX_SAMPLES = 1000 * SAMPLES
+
+# Times a Gibbs chain tries to draw a starting state that fits the evidence
+START_TRIES = 1000
+
+# Compiled family sampled by sample_chain in each worker process
+worker_family = None
+
+# Maps a family shape (the tuple of each person's parent indexes) to its
+# junction tree and inheritance factors, as returned by compile_shape
+compiled_shapes = {}
+
+
 def main():
     # Check for proper usage
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python heredity.py data.csv")
+    if len(sys.argv) in [2, 3] and os.path.isdir(sys.argv[1]):
+        output = sys.argv[2] if len(sys.argv) == 3 else "json"
+        if output not in ["json", "csv"]:
+            sys.exit("Usage: python heredity.py directory [json | csv]")
+        write_batch(batch_probabilities(sys.argv[1]), output)
+        return
+    if len(sys.argv) not in [2, 3] or (
+        len(sys.argv) == 3 and sys.argv[2] not in METHODS
+    ):
+        sys.exit("Usage: python heredity.py data.csv "
+                 f"[{' | '.join(METHODS)}]\n"
+                 "       python heredity.py directory [json | csv]")
     people = load_data(sys.argv[1])
+    method = METHODS[sys.argv[2] if len(sys.argv) == 3 else "eliminate"]
+
+    # Compute gene and trait probabilities for each person
+    probabilities = method(people)
+
+    # Print results
+    for person in people:
+        print(f"{person}:")
+        for field in probabilities[person]:
+            print(f"  {field.capitalize()}:")
+            for value in probabilities[person][field]:
+                p = probabilities[person][field][value]
+                print(f"    {value}: {p:.4f}")
 
-    # Keep track of gene and trait probabilities for each person
-    probabilities = {
+
+def empty_probabilities(people):
+    """
+    Return a gene and trait distribution for each person,
+    with every probability set to 0.
+    """
+    return {
         person: {
             "gene": {
                 2: 0,
@@ -59,38 +169,775 @@ def main():
         for person in people
     }
 
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
 
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
+def enumerate_probabilities(people):
+    """
+    Return normalized gene and trait probabilities for each person,
+    by summing the joint probability of every assignment of genes and
+    traits that is consistent with the known traits.
+
+    Assignments are built up one person at a time, parents before their
+    children, trying only traits consistent with the known traits and
+    abandoning any partial assignment whose probability is already 0.
+    Probabilities are kept as logarithms so that large families do not
+    underflow.
+    """
+    family = compile_family(people)
+    size = len(family["names"])
+    order = topological_order(family["parents"])
+
+    # Keep track of the total probability of each person's values, scaled
+    # by exp(-scale[0]) where scale[0] is the largest log joint probability
+    # seen so far, so that the totals neither underflow nor overflow
+    gene_totals = [[0.0] * 3 for _ in range(size)]
+    trait_totals = [[0.0] * 2 for _ in range(size)]
+    scale = [-math.inf]
+    genes = [0] * size
+    traits = [False] * size
+
+    def extend(position, log_p):
+        """
+        Extend the assignment of the first `position` people in `order`,
+        whose log joint probability is `log_p`, in every possible way.
+        """
+        if position == size:
+            if log_p > scale[0]:
+                factor = math.exp(scale[0] - log_p)
+                for totals in gene_totals + trait_totals:
+                    for value in range(len(totals)):
+                        totals[value] *= factor
+                scale[0] = log_p
+            p = math.exp(log_p - scale[0])
+            for person in range(size):
+                gene_totals[person][genes[person]] += p
+                trait_totals[person][traits[person]] += p
+            return
+
+        person = order[position]
+        parents = family["parents"][person]
+        known = family["traits"][person]
+        for copies in range(3):
+            if parents:
+                mother, father = parents
+                inherited = LOG_INHERITANCE[genes[mother]][genes[father]]
+                gene_log = inherited[copies]
+            else:
+                gene_log = LOG_GENE[copies]
+            if gene_log == -math.inf:
+                continue
+            genes[person] = copies
+
+            for trait in [False, True] if known is None else [known]:
+                trait_log = LOG_TRAIT[copies][trait]
+                if trait_log == -math.inf:
+                    continue
+                traits[person] = trait
+                extend(position + 1, log_p + gene_log + trait_log)
+
+    extend(0, 0.0)
+
+    probabilities = empty_probabilities(people)
+    for person, name in enumerate(family["names"]):
+        for copies in range(3):
+            probabilities[name]["gene"][copies] = gene_totals[person][copies]
+        for trait in [True, False]:
+            probabilities[name]["trait"][trait] = trait_totals[person][trait]
+
+    # Ensure probabilities sum to 1
+    normalize(probabilities)
+    return probabilities
+
+
+def topological_order(parents):
+    """
+    Return the people of a compiled family with each person's parents
+    coming before them, given the (mother, father) indexes of each person.
+    """
+    order = []
+    placed = set()
+    for person in range(len(parents)):
+        stack = [person]
+        while stack:
+            current = stack[-1]
+            waiting = [
+                parent for parent in parents[current] if parent not in placed
+            ]
+            if current in placed:
+                stack.pop()
+            elif waiting:
+                stack.extend(waiting)
+            else:
+                placed.add(current)
+                order.append(current)
+                stack.pop()
+    return order
+
+
+def vectorized_probabilities(people):
+    """
+    Return normalized gene and trait probabilities for each person,
+    as enumerate_probabilities does, but evaluating the joint probability
+    of many assignments at once as NumPy array operations.
+
+    Gene assignments are taken CHUNK at a time (fewer if there are many
+    trait assignments) as rows of an integer array, with every trait
+    assignment consistent with the known traits evaluated against each.
+    """
+    family = compile_family(people)
+    size = len(family["names"])
+    gene_table = numpy.array(GENE)
+    inheritance = numpy.array(INHERITANCE)
+    trait_table = numpy.array(TRAIT)
+
+    # Parent indexes, pointing people without known parents at themselves
+    has_parents = numpy.array([bool(parents) for parents in family["parents"]])
+    mothers = numpy.array([
+        parents[0] if parents else person
+        for person, parents in enumerate(family["parents"])
+    ], dtype=int).reshape(size)
+    fathers = numpy.array([
+        parents[1] if parents else person
+        for person, parents in enumerate(family["parents"])
+    ], dtype=int).reshape(size)
+
+    # Every assignment of traits consistent with the known traits
+    unknown = [
+        person for person, trait in enumerate(family["traits"])
+        if trait is None
+    ]
+    traits = numpy.array(
+        [[int(bool(trait)) for trait in family["traits"]]],
+        dtype=int
+    ).reshape(1, size).repeat(2 ** len(unknown), axis=0)
+    traits[:, unknown] = numpy.array(
+        list(itertools.product([0, 1], repeat=len(unknown))), dtype=int
+    ).reshape(len(traits), len(unknown))
+
+    gene_totals = numpy.zeros(3 * size)
+    trait_totals = numpy.zeros(2 * size)
+    places = 3 ** numpy.arange(size)
+    rows = max(1, CHUNK // (len(traits) * max(size, 1)))
+    for start in range(0, 3 ** size, rows):
+
+        # Each row gives the genes of every person, as base-3 digits
+        codes = numpy.arange(start, min(start + rows, 3 ** size))
+        genes = codes[:, None] // places % 3
+
+        gene_p = numpy.where(
+            has_parents,
+            inheritance[genes[:, mothers], genes[:, fathers], genes],
+            gene_table[genes]
+        ).prod(axis=1)
+        trait_p = trait_table[genes[:, None, :], traits[None, :, :]].prod(
+            axis=2
+        )
+        joint = gene_p[:, None] * trait_p
+
+        # Scatter-add each assignment's probability into the totals
+        # of the values it gives each person
+        gene_totals += numpy.bincount(
+            (genes + 3 * numpy.arange(size)).ravel(),
+            weights=joint.sum(axis=1).repeat(size),
+            minlength=3 * size
         )
-        if fails_evidence:
+        trait_totals += numpy.bincount(
+            (traits + 2 * numpy.arange(size)).ravel(),
+            weights=joint.sum(axis=0).repeat(size),
+            minlength=2 * size
+        )
+
+    gene_totals = gene_totals.reshape(size, 3).tolist()
+    trait_totals = trait_totals.reshape(size, 2).tolist()
+    probabilities = empty_probabilities(people)
+    for person, name in enumerate(family["names"]):
+        for genes in range(3):
+            probabilities[name]["gene"][genes] = gene_totals[person][genes]
+        for trait in [True, False]:
+            probabilities[name]["trait"][trait] = trait_totals[person][trait]
+
+    # Ensure probabilities sum to 1
+    normalize(probabilities)
+    return probabilities
+
+
+def compile_family(people):
+    """
+    Return a family in integer-coded form, as a dictionary of:
+        * "names": the names of the people, in order,
+        * "parents": the (mother, father) indexes of each person,
+          or an empty tuple if their parents are not known,
+        * "traits": each person's known trait, or None.
+    """
+    names = list(people)
+    index = {name: i for i, name in enumerate(names)}
+    return {
+        "names": names,
+        "parents": [parent_indexes(people[name], index) for name in names],
+        "traits": [people[name]["trait"] for name in names]
+    }
+
+
+def eliminate_probabilities(people):
+    """
+    Return normalized gene and trait probabilities for each person,
+    by exact message passing over a junction tree of the family.
+
+    Time is linear in the number of people for families whose moral
+    graph is a tree (more generally, exponential only in its treewidth).
+    """
+    family = compile_family(people)
+    names = family["names"]
+    cliques, inheritance = compile_shape(tuple(family["parents"]))
+
+    # Each person's factor: how likely their genes are given their
+    # parents' genes, times how likely their known trait is given them
+    factors = []
+    for (variables, values), trait in zip(inheritance, family["traits"]):
+        if trait is not None:
+            values = {
+                genes: p * TRAIT[genes[-1]][trait]
+                for genes, p in values.items()
+            }
+        factors.append((variables, values))
+
+    marginals = calibrate(cliques, factors)
+
+    probabilities = empty_probabilities(people)
+    for person, name in enumerate(names):
+        gene = marginals[person]
+        total = sum(gene)
+        for genes in range(3):
+            probabilities[name]["gene"][genes] = gene[genes] / total
+
+        trait = people[name]["trait"]
+        for value in [True, False]:
+            if trait is None:
+                probabilities[name]["trait"][value] = sum(
+                    probabilities[name]["gene"][genes] * TRAIT[genes][value]
+                    for genes in range(3)
+                )
+            else:
+                probabilities[name]["trait"][value] = float(value == trait)
+    return probabilities
+
+
+def compile_shape(parents):
+    """
+    Return (cliques, factors) for a family shape, given as a tuple of the
+    (mother, father) indexes of each person: the junction tree of the
+    family, and each person's (variables, values) factor giving how likely
+    their genes are given their parents' genes.
+
+    Results are cached in compiled_shapes, so families with the same shape
+    share them; they must not be modified.
+    """
+    if parents not in compiled_shapes:
+        factors = []
+        for person, person_parents in enumerate(parents):
+            variables = person_parents + (person,)
+            values = {
+                genes: gene_probability(genes[:-1], genes[-1])
+                for genes in assignments(variables)
+            }
+            factors.append((variables, values))
+        compiled_shapes[parents] = (junction_tree(parents), factors)
+    return compiled_shapes[parents]
+
+
+def batch_probabilities(directory, processes=None):
+    """
+    Yield a result for each family CSV file in a directory, in sorted
+    order, computed by eliminate_probabilities across a process pool:
+    a dictionary of the file and its probabilities, or of the file and
+    the reason they could not be computed.
+
+    Each worker reads its own files and compiles each family shape it
+    meets once, so results stream out as they are computed.
+    """
+    filenames = sorted(
+        filename for filename in os.listdir(directory)
+        if filename.endswith(".csv")
+    )
+    jobs = [(directory, filename) for filename in filenames]
+
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(family_probabilities, jobs, chunksize=16)
+
+
+def family_probabilities(job):
+    """
+    Return the batch result for a job of (directory, filename).
+    """
+    directory, filename = job
+    result = {"file": filename}
+    try:
+        people = load_data(os.path.join(directory, filename))
+    except (OSError, KeyError, ValueError, csv.Error) as error:
+        result["error"] = f"Could not read file: {error!r}"
+        return result
+
+    for person in people.values():
+        for parent in [person["mother"], person["father"]]:
+            if parent is not None and parent not in people:
+                result["error"] = f"Parent not found: {parent}"
+                return result
+
+    result["probabilities"] = eliminate_probabilities(people)
+    return result
+
+
+def write_batch(results, output):
+    """
+    Write batch results to stdout as they arrive, as one JSON object per
+    file, or as CSV rows with one row per person (or per failed file).
+    """
+    if output == "json":
+        for result in results:
+            print(json.dumps(result), flush=True)
+        return
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow([
+        "file", "name", "gene_2", "gene_1", "gene_0",
+        "trait_true", "trait_false", "error"
+    ])
+    for result in results:
+        if "error" in result:
+            writer.writerow([result["file"]] + [""] * 6 + [result["error"]])
+        else:
+            for name, person in result["probabilities"].items():
+                writer.writerow([
+                    result["file"], name,
+                    person["gene"][2], person["gene"][1], person["gene"][0],
+                    person["trait"][True], person["trait"][False], ""
+                ])
+        sys.stdout.flush()
+
+
+def parent_indexes(person, index):
+    """
+    Return the (mother, father) indexes of a person,
+    or an empty tuple if their parents are not known.
+    """
+    if person["mother"] is None or person["father"] is None:
+        return ()
+    return (index[person["mother"]], index[person["father"]])
+
+
+def gene_probability(parent_genes, genes):
+    """
+    Return the probability that a person has `genes` copies of the gene,
+    given the (mother, father) copies `parent_genes`, or unconditionally
+    if `parent_genes` is empty.
+    """
+    if not parent_genes:
+        return GENE[genes]
+    mother, father = parent_genes
+    return INHERITANCE[mother][father][genes]
+
+
+def junction_tree(parents):
+    """
+    Return the cliques of a junction tree for a family, given the
+    (mother, father) indexes of each person (or an empty tuple).
+
+    People are eliminated one at a time, each time choosing the one with
+    the fewest neighbours in the moral graph. Each elimination gives a
+    clique, as a dictionary of:
+        * "person": the person eliminated,
+        * "scope": the people whose genes the clique ranges over,
+        * "separator": the scope without the person eliminated,
+        * "parent": the clique sharing the separator, or None at a root,
+        * "factors": the people whose factors belong to this clique.
+    Cliques are listed in elimination order, so every clique
+    comes before its parent.
+    """
+    neighbors = [set() for _ in parents]
+    for person, person_parents in enumerate(parents):
+        family = set(person_parents) | {person}
+        for member in family:
+            neighbors[member] |= family - {member}
+
+    # Heap of (neighbour count, person), with stale entries skipped
+    heap = [(len(neighbors[person]), person) for person in range(len(parents))]
+    heapq.heapify(heap)
+
+    cliques = []
+    position = dict()
+    while heap:
+        count, person = heapq.heappop(heap)
+        if person in position or count != len(neighbors[person]):
             continue
+        separator = neighbors[person]
+        for neighbor in separator:
+            neighbors[neighbor] |= separator - {neighbor}
+            neighbors[neighbor].discard(person)
+            heapq.heappush(heap, (len(neighbors[neighbor]), neighbor))
+        position[person] = len(cliques)
+        cliques.append({
+            "person": person,
+            "scope": (person,) + tuple(sorted(separator)),
+            "separator": tuple(sorted(separator)),
+            "parent": None,
+            "factors": []
+        })
+
+    # Link each clique to the clique of the first of its separator to go
+    for clique in cliques:
+        if clique["separator"]:
+            clique["parent"] = min(
+                position[person] for person in clique["separator"]
+            )
+
+    # Give each factor to the clique of the first of its people to go
+    for person, person_parents in enumerate(parents):
+        first = min(position[member] for member in person_parents + (person,))
+        cliques[first]["factors"].append(person)
+
+    return cliques
+
+
+def calibrate(cliques, factors):
+    """
+    Return the unnormalized gene marginal [P(0), P(1), P(2)] of each person,
+    passing messages up and then down the junction tree `cliques`, where
+    factors[person] is the (variables, values) factor of each person.
+    """
+    potentials = [
+        factor_table(
+            clique["scope"], [factors[person] for person in clique["factors"]]
+        )
+        for clique in cliques
+    ]
+    children = [[] for _ in cliques]
+    for k, clique in enumerate(cliques):
+        if clique["parent"] is not None:
+            children[clique["parent"]].append(k)
+
+    # Upward pass: children come before their parents
+    up = [None] * len(cliques)
+    for k, clique in enumerate(cliques):
+        incoming = [(cliques[c]["separator"], up[c]) for c in children[k]]
+        table = product_table(clique["scope"], potentials[k], incoming)
+        up[k] = sum_out(clique["scope"], table, clique["separator"])
+
+    # Downward pass: parents come before their children
+    down = [None] * len(cliques)
+    for k in reversed(range(len(cliques))):
+        parent = cliques[k]["parent"]
+        if parent is None:
+            continue
+        incoming = [
+            (cliques[c]["separator"], up[c])
+            for c in children[parent] if c != k
+        ]
+        if down[parent] is not None:
+            incoming.append((cliques[parent]["separator"], down[parent]))
+        table = product_table(
+            cliques[parent]["scope"], potentials[parent], incoming
+        )
+        down[k] = sum_out(
+            cliques[parent]["scope"], table, cliques[k]["separator"]
+        )
+
+    marginals = [None] * len(cliques)
+    for k, clique in enumerate(cliques):
+        incoming = [(cliques[c]["separator"], up[c]) for c in children[k]]
+        if down[k] is not None:
+            incoming.append((clique["separator"], down[k]))
+        table = product_table(clique["scope"], potentials[k], incoming)
+        belief = sum_out(clique["scope"], table, (clique["person"],))
+        marginals[clique["person"]] = [belief[(genes,)] for genes in range(3)]
+    return marginals
+
+
+def factor_table(scope, factors):
+    """
+    Return the product of (variables, values) factors as a table over every
+    assignment of genes to the people in `scope`.
+    """
+    return product_table(
+        scope, {genes: 1 for genes in assignments(scope)}, factors
+    )
+
+
+def product_table(scope, table, factors):
+    """
+    Return `table` over `scope` multiplied by each (variables, values)
+    factor, whose variables are all in `scope`.
+    """
+    positions = [
+        [scope.index(variable) for variable in variables]
+        for variables, _ in factors
+    ]
+    result = dict()
+    for genes, p in table.items():
+        for (_, values), places in zip(factors, positions):
+            p *= values[tuple(genes[place] for place in places)]
+        result[genes] = p
+    return result
+
+
+def sum_out(scope, table, keep):
+    """
+    Return `table` over `scope` summed over every variable not in `keep`.
+    """
+    places = [scope.index(variable) for variable in keep]
+    result = {genes: 0 for genes in assignments(keep)}
+    for genes, p in table.items():
+        result[tuple(genes[place] for place in places)] += p
+    return result
+
+
+def assignments(scope):
+    """
+    Return every assignment of 0, 1 or 2 genes to the people in `scope`.
+    """
+    return itertools.product(range(3), repeat=len(scope))
+
+
+def weighting_probabilities(people):
+    """
+    Return approximate gene and trait probabilities for each person,
+    by likelihood weighting with the default settings.
+    """
+    return sample_probabilities(people, "weighting")
+
+
+def gibbs_probabilities(people):
+    """
+    Return approximate gene and trait probabilities for each person,
+    by Gibbs sampling with the default settings.
+    """
+    return sample_probabilities(people, "gibbs")
 
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_geness in powerset(names - one_gene):
 
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_geness, have_trait)
-                update(probabilities, one_gene, two_geness, have_trait, p)
+def sample_probabilities(people, sampler, samples=SAMPLES, chains=CHAINS,
+                         error=None, max_samples=None, processes=None,
+                         seed=None):
+    """
+    Return approximate, normalized gene and trait probabilities for each
+    person, from `chains` independent sampling chains run across a
+    process pool. `sampler` is "weighting" for likelihood weighting or
+    "gibbs" for Gibbs sampling.
+
+    Each round, every chain draws `samples` more samples with a seed of its
+    own, derived from `seed`. With no `error`, a single round is run;
+    otherwise rounds continue until the standard error of every
+    probability, estimated from the spread between chains, is below
+    `error`, or until `max_samples` (by default MAX_SAMPLES) have been
+    drawn in all.
+    """
+    if sampler not in ["weighting", "gibbs"]:
+        raise ValueError(f"unknown sampler {sampler}")
+    if error is not None and chains < 2:
+        raise ValueError("at least two chains are needed to estimate error")
+    if error is not None and max_samples is None:
+        max_samples = MAX_SAMPLES
+
+    family = compile_family(people)
+    size = len(family["names"])
+    seeds = numpy.random.SeedSequence(seed)
+
+    # Each chain's totals and weight are scaled by exp(-shifts[chain]),
+    # as returned by sample_chain
+    totals = numpy.zeros((chains, size, 5))
+    weights = numpy.zeros(chains)
+    shifts = numpy.full(chains, -math.inf)
+    drawn = 0
+
+    with multiprocessing.Pool(processes, init_sampler, (family,)) as pool:
+        while True:
+            jobs = [
+                (sampler, samples, int(child.generate_state(1)[0]))
+                for child in seeds.spawn(chains)
+            ]
+            for chain, (chain_totals, weight, shift) in enumerate(
+                pool.map(sample_chain, jobs)
+            ):
+                top = max(shifts[chain], shift)
+                if top == -math.inf:
+                    continue
+                old = math.exp(shifts[chain] - top)
+                new = math.exp(shift - top)
+                totals[chain] = totals[chain] * old + numpy.array(
+                    chain_totals
+                ) * new
+                weights[chain] = weights[chain] * old + weight * new
+                shifts[chain] = top
+            drawn += samples
+
+            if error is None or (drawn + samples) * chains > max_samples:
+                break
+            if weights.min() > 0:
+                estimates = totals / weights[:, None, None]
+                errors = estimates.std(axis=0, ddof=1) / math.sqrt(chains)
+                if errors.max() < error:
+                    break
+
+    if shifts.max() == -math.inf:
+        raise ValueError("no sample is consistent with the known traits")
+    scales = numpy.exp(shifts - shifts.max())
+    totals = (
+        (totals * scales[:, None, None]).sum(axis=0) / (weights * scales).sum()
+    ).tolist()
+    probabilities = empty_probabilities(people)
+    for person, name in enumerate(family["names"]):
+        for copies in range(3):
+            probabilities[name]["gene"][copies] = totals[person][copies]
+        for trait in [True, False]:
+            probabilities[name]["trait"][trait] = totals[person][3 + trait]
 
     # Ensure probabilities sum to 1
     normalize(probabilities)
+    return probabilities
 
-    # Print results
-    for person in people:
-        print(f"{person}:")
-        for field in probabilities[person]:
-            print(f"  {field.capitalize()}:")
-            for value in probabilities[person][field]:
-                p = probabilities[person][field][value]
-                print(f"    {value}: {p:.4f}")
+
+def init_sampler(family):
+    """
+    Set the compiled family sampled by sample_chain in a worker process.
+    """
+    global worker_family
+    worker_family = family
+
+
+def sample_chain(job):
+    """
+    Return (totals, weight, shift) for one chain of sample_probabilities,
+    given its (sampler, samples, seed): for each person, the total weight
+    of samples with 0, 1 and 2 copies of the gene and without and with the
+    trait, and the total weight of all samples, both scaled by exp(-shift)
+    so that they do not underflow for large families.
+
+    Unknown traits are never sampled; each sample instead adds the
+    probability of the trait given the person's genes, which gives the
+    same expected totals with less variance.
+    """
+    sampler, samples, seed = job
+    rng = random.Random(seed)
+    family = worker_family
+    parents = family["parents"]
+    known = family["traits"]
+    size = len(parents)
+    order = topological_order(parents)
+    totals = [[0.0] * 5 for _ in range(size)]
+    weight = 0.0
+
+    # Children of each person, with the slot (0 for mother, 1 for father)
+    # that the person fills for them
+    children = [[] for _ in range(size)]
+    for child, child_parents in enumerate(parents):
+        for slot, parent in enumerate(child_parents):
+            children[parent].append((child, slot))
+
+    def choose(weights):
+        """
+        Return an index chosen with probability proportional to `weights`.
+        """
+        r = rng.random() * sum(weights)
+        for value, w in enumerate(weights):
+            r -= w
+            if r < 0:
+                return value
+        return len(weights) - 1
+
+    def prior(person, genes):
+        """
+        Return the distribution of a person's genes given their parents'.
+        """
+        if parents[person]:
+            mother, father = parents[person]
+            return INHERITANCE[genes[mother]][genes[father]]
+        return GENE
+
+    def log_prior(person, genes):
+        """
+        Return prior(person, genes) as logarithms.
+        """
+        if parents[person]:
+            mother, father = parents[person]
+            return LOG_INHERITANCE[genes[mother]][genes[father]]
+        return LOG_GENE
+
+    def forward(genes):
+        """
+        Sample genes for everyone in `genes` from the prior, parents first,
+        and return the log likelihood of the known traits.
+        """
+        log_likelihood = 0.0
+        for person in order:
+            genes[person] = choose(prior(person, genes))
+            if known[person] is not None:
+                log_likelihood += LOG_TRAIT[genes[person]][known[person]]
+        return log_likelihood
+
+    def record(genes, w):
+        """
+        Add a sample of (scaled) weight `w` to the totals.
+        """
+        for person in range(size):
+            copies = genes[person]
+            person_totals = totals[person]
+            person_totals[copies] += w
+            if known[person] is None:
+                person_totals[4] += w * TRAIT[copies][True]
+                person_totals[3] += w * TRAIT[copies][False]
+            else:
+                person_totals[3 + known[person]] += w
+
+    genes = [0] * size
+    if sampler == "weighting":
+
+        # Weights are kept relative to the largest log weight so far
+        shift = -math.inf
+        for _ in range(samples):
+            log_w = forward(genes)
+            if log_w == -math.inf:
+                continue
+            if log_w > shift:
+                factor = math.exp(shift - log_w)
+                for person_totals in totals:
+                    for value in range(5):
+                        person_totals[value] *= factor
+                weight *= factor
+                shift = log_w
+            w = math.exp(log_w - shift)
+            record(genes, w)
+            weight += w
+        return totals, weight, shift
+
+    # Gibbs sampling: start from a state consistent with the evidence,
+    # then repeatedly resample each person's genes given everyone else's
+    for _ in range(START_TRIES):
+        if forward(genes) > -math.inf:
+            break
+    else:
+        raise ValueError("no starting state fits the known traits")
+    for sweep in range(BURN_IN + samples):
+        for person in order:
+            distribution = log_prior(person, genes)
+            logs = []
+            for copies in range(3):
+                log_w = distribution[copies]
+                if known[person] is not None:
+                    log_w += LOG_TRAIT[copies][known[person]]
+                for child, slot in children[person]:
+                    mother, father = parents[child]
+                    if slot == 0:
+                        log_w += LOG_INHERITANCE[copies][genes[father]][
+                            genes[child]
+                        ]
+                    else:
+                        log_w += LOG_INHERITANCE[genes[mother]][copies][
+                            genes[child]
+                        ]
+                logs.append(log_w)
+            top = max(logs)
+            genes[person] = choose([math.exp(log_w - top) for log_w in logs])
+        if sweep >= BURN_IN:
+            record(genes, 1.0)
+            weight += 1.0
+    return totals, weight, 0.0
 
 
 def load_data(filename):
@@ -133,211 +980,32 @@ def joint_probability(people, one_gene, two_genes, have_trait):
 
     The probability returned should be the probability that
         * everyone in set `one_gene` has one copy of the gene, and
-        * everyone in set `two_geness` has two copies of the gene, and
+        * everyone in set `two_genes` has two copies of the gene, and
         * everyone not in `one_gene` or `two_genes` does not have the gene, and
         * everyone in set `have_trait` has the trait, and
         * everyone not in set` have_trait` does not have the trait.
     """
-    zero_gene = set()
-    not_have_trait = set()
+    genes = {
+        person: 2 if person in two_genes else 1 if person in one_gene else 0
+        for person in people
+    }
 
-    #get the set of people with zero genes and not having the trait
+    jointProbability = 1
     for person in people:
-        if person not in one_gene and person not in two_genes:
-            zero_gene.add(person)
-        
-        if person not in have_trait:
-            not_have_trait.add(person)
-
-    probabilities = list()
-
-    #calculating the probabiity of people having zero genes
-    for p0 in zero_gene:
-        mother = people[p0]["mother"]
-        father = people[p0]["father"]
-        prob = 1
+        mother = people[person]["mother"]
+        father = people[person]["father"]
+        copies = genes[person]
 
-        #calculating unconditional probabilities for parents
-        if mother == None and father == None:
-            if p0 in have_trait:
-                prob = PROBS["gene"][0] * PROBS["trait"][0][True]
-                probabilities.append(prob)
-            elif p0 in not_have_trait:
-                prob = PROBS["gene"][0] * PROBS["trait"][0][False]
-                probabilities.append(prob)
-
-        #for child
-        else:
-            notGetFrom0 = 1 - PROBS["mutation"]
-            notGetFrom1 = 1 - 0.5 
-            notGetfrom2 = PROBS["mutation"]
-
-
-            #going through all the possible combinations of genes mother and father can have
-            if mother in zero_gene and father in zero_gene:
-                prob = pow((notGetFrom0),2)
-                
-            elif mother in zero_gene and father in one_gene:
-                prob = notGetFrom0 * notGetFrom1
-                
-            elif mother in zero_gene and father in two_genes:
-                prob = notGetFrom0 * notGetfrom2
-                
-            elif mother in one_gene and father in zero_gene:
-                prob = notGetFrom1 * notGetFrom0
-                            
-            elif mother in one_gene and father in one_gene:
-                prob = notGetFrom1 * notGetFrom1
-                
-            elif mother in one_gene and father in two_genes:
-                prob = notGetfrom2 * notGetFrom1
-                
-            elif mother in two_genes and father in zero_gene:
-                prob = notGetFrom0 * notGetfrom2
-                
-            elif mother in two_genes and father in one_gene:
-                prob = notGetfrom2 * notGetFrom1
-                
-            elif mother in two_genes and father in two_genes:
-                prob = notGetfrom2 * notGetfrom2
-                
-            #calculating the final probability including the trait probability
-            if p0 in have_trait:
-                finalProb = prob * PROBS["trait"][0][True]
-                probabilities.append(finalProb)
-            elif p0 in not_have_trait:
-                finalProb = prob * PROBS["trait"][0][False]
-                probabilities.append(finalProb)
-
-
-    #people having one gene
-    for p1 in one_gene:
-        mother = people[p1]["mother"]
-        father = people[p1]["father"]
-        prob = 1
-
-        #for parents
-        if mother == None and father == None:
-            if p1 in have_trait:
-                prob = PROBS["gene"][1] * PROBS["trait"][1][True]
-                probabilities.append(prob)
-            elif p1 in not_have_trait:
-                prob = PROBS["gene"][1] * PROBS["trait"][1][False]
-                probabilities.append(prob)
-
-        #for children
+        #unconditional probability for parents, inherited one for children
+        if mother is None or father is None:
+            jointProbability *= GENE[copies]
         else:
-            getFrom0 = PROBS["mutation"]
-            notGetFrom0 = 1 - PROBS["mutation"]
-
-            getFrom1 = 0.5
-            notGetFrom1 = 1 - getFrom1
-
-            getFrom2 = 1 - PROBS["mutation"]
-            notGetfrom2 = PROBS["mutation"]
-
-            #going through all the possible combinations of genes mother and father can have
-            if mother in zero_gene and father in zero_gene:
-                prob = getFrom0 * notGetFrom0 + getFrom0 * notGetFrom0
-                
-            elif mother in zero_gene and father in one_gene:
-                prob = getFrom0 * notGetFrom1 + getFrom1 * notGetFrom0
-                
-            elif mother in zero_gene and father in two_genes:
-                prob = getFrom0 * notGetfrom2 + getFrom2 * notGetFrom0
-                
-            elif mother in one_gene and father in zero_gene:
-                prob = getFrom1 * notGetFrom0 + getFrom0 * notGetFrom1
-                            
-            elif mother in one_gene and father in one_gene:
-                prob = (getFrom1 * notGetFrom1) + (getFrom1 * notGetFrom1)
-                
-            elif mother in one_gene and father in two_genes:
-                prob = getFrom1 * notGetfrom2 + getFrom2 * notGetFrom1
-                
-            elif mother in two_genes and father in zero_gene:
-                prob = getFrom2 * notGetFrom0 + getFrom0 * notGetfrom2
-                
-            elif mother in two_genes and father in one_gene:
-                prob = getFrom2 * notGetFrom1 + getFrom1 * notGetfrom2
-                
-            elif mother in two_genes and father in two_genes:
-                prob = (getFrom2 * notGetfrom2) + (getFrom2 * notGetfrom2)
-                
-
-            #calculating the final probability
-            if p1 in have_trait:
-                finalProb = prob * PROBS["trait"][1][True]
-                probabilities.append(finalProb)
-            elif p1 in not_have_trait:
-                finalProb = prob * PROBS["trait"][1][False]
-                probabilities.append(finalProb)
-    
-
-    #for people having two genes
-    for p2 in two_genes:
-        mother = people[p2]["mother"]
-        father = people[p2]["father"]
-        prob = 1
-        
-        #for parents
-        if mother == None and father == None:
-            if p2 in have_trait:
-                prob = PROBS["gene"][2] * PROBS["trait"][2][True]
-                probabilities.append(prob)
-            elif p2 in not_have_trait:
-                prob = PROBS["gene"][2] * PROBS["trait"][2][False]
-                probabilities.append(prob)
-
-        #for child
-        else:
-            getFrom0 = PROBS["mutation"]
-            getFrom1 = 0.5
-            getFrom2 = 1 - PROBS["mutation"]
-            
-            #going through all the possible combinations of genes mother and father can have
-            if mother in zero_gene and father in zero_gene:
-                prob = pow((getFrom0),2)
-                
-            elif mother in zero_gene and father in one_gene:
-                prob = getFrom0 * getFrom1
-                
-            elif mother in zero_gene and father in two_genes:
-                prob = getFrom0 *  getFrom2 
-                
-            elif mother in one_gene and father in zero_gene:
-                prob = getFrom1 * getFrom0 
-                            
-            elif mother in one_gene and father in one_gene:
-                prob = pow((getFrom1),2)
-                
-            elif mother in one_gene and father in two_genes:
-                prob = getFrom1 * getFrom2 
-                
-            elif mother in two_genes and father in zero_gene:
-                prob = getFrom2 * getFrom0 
-                
-            elif mother in two_genes and father in one_gene:
-                prob = getFrom2 * getFrom1
-                
-            elif mother in two_genes and father in two_genes:
-                prob = pow((getFrom2),2)
-                
-            #calculating the final probability
-            if p2 in have_trait:
-                finalProb = prob * PROBS["trait"][2][True]
-                probabilities.append(finalProb)
-            elif p2 in not_have_trait:
-                finalProb = prob * PROBS["trait"][2][False]
-                probabilities.append(finalProb)
-
-
-    jointProbability = 1 
-    for probability in probabilities:
-        jointProbability *= probability
+            inherited = INHERITANCE[genes[mother]][genes[father]]
+            jointProbability *= inherited[copies]
 
-    return jointProbability
+        jointProbability *= TRAIT[copies][person in have_trait]
 
+    return jointProbability
 
 
 def update(probabilities, one_gene, two_genes, have_trait, p):
@@ -399,5 +1067,15 @@ def normalize(probabilities):
             probabilities[person]["trait"][bol] *= normalizer2
 
 
+# Ways of computing probabilities that main can use
+METHODS = {
+    "eliminate": eliminate_probabilities,
+    "enumerate": enumerate_probabilities,
+    "vectorize": vectorized_probabilities,
+    "weighting": weighting_probabilities,
+    "gibbs": gibbs_probabilities
+}
+
+
 if __name__ == "__main__":
     main()
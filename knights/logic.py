@@ -1,7 +1,61 @@
+import heapq
 import itertools
+import weakref
 
+# Models evaluated at once by bitset_check, as a power of two
+CHUNK_BITS = 16
 
-class Sentence():
+# Largest number of symbols model_check evaluates every model for by default
+BITSET_SYMBOLS = 20
+
+
+class Shared(type):
+    """
+    Metaclass of sentences, which sets up each new sentence's caches and,
+    for immutable sentences, returns the existing equal sentence instead,
+    so that equal ones are created once and shared.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        sentence = cls.__new__(cls)
+
+        # Caches for symbol_set and __hash__
+        sentence.cached_symbols = None
+        sentence.cached_hash = None
+
+        # Sentences that contain this one, by identity
+        sentence.parents = weakref.WeakValueDictionary()
+
+        sentence.__init__(*args, **kwargs)
+        if cls.immutable:
+            key = (cls,) + sentence.key()
+            existing = Sentence.shared.get(key)
+            if existing is not None:
+                return existing
+            Sentence.shared[key] = sentence
+        return sentence
+
+
+class Sentence(metaclass=Shared):
+
+    # Immutable sentences by class and key, so that equal ones are shared
+    shared = weakref.WeakValueDictionary()
+
+    # Whether sentences of this class are immutable, and so can be shared
+    immutable = False
+
+    def __reduce__(self):
+        # Rebuild from parts when unpickled or copied, so that caches and
+        # parents (which cannot be pickled) start afresh and are shared
+        return (type(self), self.parts())
+
+    def key(self):
+        """
+        Returns a tuple that tells the sentence apart from others of its
+        class: its parts, by identity, since equal immutable parts are the
+        same object.
+        """
+        return tuple(id(part) for part in self.parts())
 
     def evaluate(self, model):
         """Evaluates the logical sentence."""
@@ -13,7 +67,51 @@ class Sentence():
 
     def symbols(self):
         """Returns a set of all symbols in the logical sentence."""
-        return set()
+        return set(self.symbol_set())
+
+    def symbol_set(self):
+        """Returns a cached frozenset of all symbols in the sentence."""
+        if self.cached_symbols is None:
+            self.cached_symbols = frozenset().union(
+                *[part.symbol_set() for part in self.parts()]
+            )
+        return self.cached_symbols
+
+    def parts(self):
+        """Returns the sentences that the logical sentence is made of."""
+        return ()
+
+    def link(self, part):
+        """Records that the sentence contains part, for invalidate."""
+        part.parents[id(self)] = self
+
+    def invalidate(self):
+        """
+        Clears the caches of the sentence and of every sentence containing
+        it. A sentence's parts are cached whenever it is, so the walk can
+        stop at sentences with nothing cached.
+        """
+        if self.cached_symbols is None and self.cached_hash is None:
+            return
+        self.cached_symbols = None
+        self.cached_hash = None
+        for parent in list(self.parents.values()):
+            parent.invalidate()
+
+    def expression(self, slots):
+        """
+        Returns a Python expression for the logical sentence in a
+        bit-packed model m, where symbol slots[name] is bit slots[name].
+        """
+        raise Exception("nothing to compile")
+
+    def column(self, columns, ones):
+        """
+        Returns an int whose bit m is the value of the logical sentence in
+        model m, given the same for each symbol in columns, and `ones`
+        with a bit set for every model.
+        """
+        raise Exception("nothing to evaluate")
 
     @classmethod
     def validate(cls, sentence):
@@ -43,15 +141,20 @@ class Sentence():
 
 
 class Symbol(Sentence):
+    immutable = True
 
     def __init__(self, name):
         self.name = name
 
     def __eq__(self, other):
-        return isinstance(other, Symbol) and self.name == other.name
+        return self is other or (
+            isinstance(other, Symbol) and self.name == other.name
+        )
 
     def __hash__(self):
-        return hash(("symbol", self.name))
+        if self.cached_hash is None:
+            self.cached_hash = hash(("symbol", self.name))
+        return self.cached_hash
 
     def __repr__(self):
         return self.name
@@ -65,20 +168,43 @@ class Symbol(Sentence):
     def formula(self):
         return self.name
 
-    def symbols(self):
-        return {self.name}
+    def __reduce__(self):
+        return (Symbol, (self.name,))
+
+    def key(self):
+        return (self.name,)
+
+    def symbol_set(self):
+        if self.cached_symbols is None:
+            self.cached_symbols = frozenset([self.name])
+        return self.cached_symbols
+
+    def expression(self, slots):
+        return f"(m & {1 << slots[self.name]} != 0)"
+
+    def column(self, columns, ones):
+        return columns[self.name]
 
 
 class Not(Sentence):
+    immutable = True
+
     def __init__(self, operand):
         Sentence.validate(operand)
         self.operand = operand
+        self.link(operand)
 
     def __eq__(self, other):
-        return isinstance(other, Not) and self.operand == other.operand
+        return self is other or (
+            isinstance(other, Not)
+            and hash(self) == hash(other)
+            and self.operand == other.operand
+        )
 
     def __hash__(self):
-        return hash(("not", hash(self.operand)))
+        if self.cached_hash is None:
+            self.cached_hash = hash(("not", hash(self.operand)))
+        return self.cached_hash
 
     def __repr__(self):
         return f"Not({self.operand})"
@@ -89,8 +215,14 @@ class Not(Sentence):
     def formula(self):
         return "¬" + Sentence.parenthesize(self.operand.formula())
 
-    def symbols(self):
-        return self.operand.symbols()
+    def parts(self):
+        return (self.operand,)
+
+    def expression(self, slots):
+        return f"(not {self.operand.expression(slots)})"
+
+    def column(self, columns, ones):
+        return ones ^ self.operand.column(columns, ones)
 
 
 class And(Sentence):
@@ -98,14 +230,22 @@ class And(Sentence):
         for conjunct in conjuncts:
             Sentence.validate(conjunct)
         self.conjuncts = list(conjuncts)
+        for conjunct in conjuncts:
+            self.link(conjunct)
 
     def __eq__(self, other):
-        return isinstance(other, And) and self.conjuncts == other.conjuncts
+        return self is other or (
+            isinstance(other, And)
+            and hash(self) == hash(other)
+            and self.conjuncts == other.conjuncts
+        )
 
     def __hash__(self):
-        return hash(
-            ("and", tuple(hash(conjunct) for conjunct in self.conjuncts))
-        )
+        if self.cached_hash is None:
+            self.cached_hash = hash(
+                ("and", tuple(hash(conjunct) for conjunct in self.conjuncts))
+            )
+        return self.cached_hash
 
     def __repr__(self):
         conjunctions = ", ".join(
@@ -116,6 +256,8 @@ class And(Sentence):
     def add(self, conjunct):
         Sentence.validate(conjunct)
         self.conjuncts.append(conjunct)
+        self.link(conjunct)
+        self.invalidate()
 
     def evaluate(self, model):
         return all(conjunct.evaluate(model) for conjunct in self.conjuncts)
@@ -126,23 +268,46 @@ class And(Sentence):
         return " ∧ ".join([Sentence.parenthesize(conjunct.formula())
                            for conjunct in self.conjuncts])
 
-    def symbols(self):
-        return set.union(*[conjunct.symbols() for conjunct in self.conjuncts])
+    def parts(self):
+        return tuple(self.conjuncts)
+
+    def expression(self, slots):
+        if not self.conjuncts:
+            return "True"
+        return "(" + " and ".join(
+            [conjunct.expression(slots) for conjunct in self.conjuncts]
+        ) + ")"
+
+    def column(self, columns, ones):
+        result = ones
+        for conjunct in self.conjuncts:
+            result &= conjunct.column(columns, ones)
+        return result
 
 
 class Or(Sentence):
+    immutable = True
+
     def __init__(self, *disjuncts):
         for disjunct in disjuncts:
             Sentence.validate(disjunct)
         self.disjuncts = list(disjuncts)
+        for disjunct in disjuncts:
+            self.link(disjunct)
 
     def __eq__(self, other):
-        return isinstance(other, Or) and self.disjuncts == other.disjuncts
+        return self is other or (
+            isinstance(other, Or)
+            and hash(self) == hash(other)
+            and self.disjuncts == other.disjuncts
+        )
 
     def __hash__(self):
-        return hash(
-            ("or", tuple(hash(disjunct) for disjunct in self.disjuncts))
-        )
+        if self.cached_hash is None:
+            self.cached_hash = hash(
+                ("or", tuple(hash(disjunct) for disjunct in self.disjuncts))
+            )
+        return self.cached_hash
 
     def __repr__(self):
         disjuncts = ", ".join([str(disjunct) for disjunct in self.disjuncts])
@@ -157,24 +322,48 @@ class Or(Sentence):
         return " ∨  ".join([Sentence.parenthesize(disjunct.formula())
                             for disjunct in self.disjuncts])
 
-    def symbols(self):
-        return set.union(*[disjunct.symbols() for disjunct in self.disjuncts])
+    def parts(self):
+        return tuple(self.disjuncts)
+
+    def expression(self, slots):
+        if not self.disjuncts:
+            return "False"
+        return "(" + " or ".join(
+            [disjunct.expression(slots) for disjunct in self.disjuncts]
+        ) + ")"
+
+    def column(self, columns, ones):
+        result = 0
+        for disjunct in self.disjuncts:
+            result |= disjunct.column(columns, ones)
+        return result
 
 
 class Implication(Sentence):
+    immutable = True
+
     def __init__(self, antecedent, consequent):
         Sentence.validate(antecedent)
         Sentence.validate(consequent)
         self.antecedent = antecedent
         self.consequent = consequent
+        self.link(antecedent)
+        self.link(consequent)
 
     def __eq__(self, other):
-        return (isinstance(other, Implication)
-                and self.antecedent == other.antecedent
-                and self.consequent == other.consequent)
+        return self is other or (
+            isinstance(other, Implication)
+            and hash(self) == hash(other)
+            and self.antecedent == other.antecedent
+            and self.consequent == other.consequent
+        )
 
     def __hash__(self):
-        return hash(("implies", hash(self.antecedent), hash(self.consequent)))
+        if self.cached_hash is None:
+            self.cached_hash = hash(
+                ("implies", hash(self.antecedent), hash(self.consequent))
+            )
+        return self.cached_hash
 
     def __repr__(self):
         return f"Implication({self.antecedent}, {self.consequent})"
@@ -188,24 +377,45 @@ class Implication(Sentence):
         consequent = Sentence.parenthesize(self.consequent.formula())
         return f"{antecedent} => {consequent}"
 
-    def symbols(self):
-        return set.union(self.antecedent.symbols(), self.consequent.symbols())
+    def parts(self):
+        return (self.antecedent, self.consequent)
+
+    def expression(self, slots):
+        antecedent = self.antecedent.expression(slots)
+        consequent = self.consequent.expression(slots)
+        return f"(not {antecedent} or {consequent})"
+
+    def column(self, columns, ones):
+        antecedent = self.antecedent.column(columns, ones)
+        consequent = self.consequent.column(columns, ones)
+        return (ones ^ antecedent) | consequent
 
 
 class Biconditional(Sentence):
+    immutable = True
+
     def __init__(self, left, right):
         Sentence.validate(left)
         Sentence.validate(right)
         self.left = left
         self.right = right
+        self.link(left)
+        self.link(right)
 
     def __eq__(self, other):
-        return (isinstance(other, Biconditional)
-                and self.left == other.left
-                and self.right == other.right)
+        return self is other or (
+            isinstance(other, Biconditional)
+            and hash(self) == hash(other)
+            and self.left == other.left
+            and self.right == other.right
+        )
 
     def __hash__(self):
-        return hash(("biconditional", hash(self.left), hash(self.right)))
+        if self.cached_hash is None:
+            self.cached_hash = hash(
+                ("biconditional", hash(self.left), hash(self.right))
+            )
+        return self.cached_hash
 
     def __repr__(self):
         return f"Biconditional({self.left}, {self.right})"
@@ -221,43 +431,499 @@ class Biconditional(Sentence):
         right = Sentence.parenthesize(str(self.right))
         return f"{left} <=> {right}"
 
-    def symbols(self):
-        return set.union(self.left.symbols(), self.right.symbols())
-
+    def parts(self):
+        return (self.left, self.right)
+
+    def expression(self, slots):
+        left = self.left.expression(slots)
+        right = self.right.expression(slots)
+        return f"({left} == {right})"
+
+    def column(self, columns, ones):
+        left = self.left.column(columns, ones)
+        right = self.right.column(columns, ones)
+        return ones ^ left ^ right
+
+
+def compile_sentence(sentence, symbols):
+    """
+    Compiles a sentence into a function of a bit-packed model: an int
+    whose bit i is the value of symbols[i].
+    """
+    slots = {name: i for i, name in enumerate(symbols)}
+    return eval(f"lambda m: {sentence.expression(slots)}")
+
+
+def truth_table(sentence, symbols=None):
+    """
+    Returns a list of the sentence's values in every model, indexed by
+    the bit-packed model over symbols (by default, its sorted symbols).
+    """
+    if symbols is None:
+        symbols = sorted(sentence.symbols())
+    function = compile_sentence(sentence, symbols)
+    return [function(m) for m in range(2 ** len(symbols))]
+
+
+def model_check(knowledge, query, method=None):
+    """
+    Checks if knowledge base entails query.
+
+    With method "bitset", evaluates every model at once with bitwise
+    operations; with method "sat", checks that knowledge ∧ ¬query is
+    unsatisfiable using a SAT solver; with method "enumerate", checks
+    every model one by one. By default, uses "bitset" for up to
+    BITSET_SYMBOLS symbols, and "sat" otherwise.
+    """
+    if method is None:
+        symbols = knowledge.symbol_set() | query.symbol_set()
+        method = "bitset" if len(symbols) <= BITSET_SYMBOLS else "sat"
+
+    if method == "bitset":
+        return bitset_check(knowledge, query)
+    elif method == "enumerate":
+        return enumerate_check(knowledge, query)
+    elif method != "sat":
+        raise ValueError(f"unknown method {method}")
+
+    encoder = Encoder()
+    encoder.add(knowledge)
+    return not encoder.solver.solve([-encoder.literal(query)])
+
+
+def bitset_check(knowledge, query):
+    """
+    Checks if knowledge base entails query, by evaluating models in chunks
+    of 2 ** CHUNK_BITS, with one bit per model in each int.
+    """
+    symbols = sorted(knowledge.symbol_set() | query.symbol_set())
+    bits = min(len(symbols), CHUNK_BITS)
+    ones = (1 << (1 << bits)) - 1
+
+    # Symbols below the chunk size alternate within a chunk
+    columns = dict()
+    for i, name in enumerate(symbols[:bits]):
+        pattern = ((1 << (1 << i)) - 1) << (1 << i)
+        width = 1 << (i + 1)
+        while width < 1 << bits:
+            pattern |= pattern << width
+            width *= 2
+        columns[name] = pattern
+
+    # Others are constant within a chunk, given by the chunk's number
+    for chunk in range(2 ** (len(symbols) - bits)):
+        for i, name in enumerate(symbols[bits:]):
+            columns[name] = ones if chunk >> i & 1 else 0
+
+        # Look for a model where knowledge is true but query is false
+        if knowledge.column(columns, ones) & ~query.column(columns, ones):
+            return False
+    return True
+
+
+def enumerate_check(knowledge, query):
+    """Checks if knowledge base entails query, by checking every model."""
 
-def model_check(knowledge, query):
-    """Checks if knowledge base entails query."""
+    # Get all symbols in both knowledge and query
+    symbols = sorted(knowledge.symbol_set() | query.symbol_set())
+    knowledge = compile_sentence(knowledge, symbols)
+    query = compile_sentence(query, symbols)
 
-    def check_all(knowledge, query, symbols, model):
-        """Checks if knowledge base entails query, given a particular model."""
+    # If knowledge base is true in a model, then query must also be true
+    for model in range(2 ** len(symbols)):
+        if knowledge(model) and not query(model):
+            return False
+    return True
 
-        # If model has an assignment for each symbol
-        if not symbols:
 
-            # If knowledge base is true in model, then query must also be true
-            if knowledge.evaluate(model):
-                return query.evaluate(model)
-            return True
-        else:
+class KnowledgeBase():
+    """
+    Knowledge base that answers queries with one SAT solver, so clauses
+    compiled from the knowledge and clauses learned while answering one
+    query are reused by the next.
+    """
 
-            # Choose one of the remaining unused symbols
-            remaining = symbols.copy()
-            p = remaining.pop()
+    def __init__(self, *sentences):
+        self.encoder = Encoder()
 
-            # Create a model where the symbol is true
-            model_true = model.copy()
-            model_true[p] = True
+        # Stack of assumed sentences, as solver literals
+        self.assumptions = []
 
-            # Create a model where the symbol is false
-            model_false = model.copy()
-            model_false[p] = False
+        for sentence in sentences:
+            self.add(sentence)
 
-            # Ensure entailment holds in both models
-            return (check_all(knowledge, query, remaining, model_true) and
-                    check_all(knowledge, query, remaining, model_false))
+    def add(self, sentence):
+        """Adds a sentence to the knowledge base for good."""
+        self.encoder.add(sentence)
 
-    # Get all symbols in both knowledge and query
-    symbols = set.union(knowledge.symbols(), query.symbols())
+    def push(self, *sentences):
+        """Assumes sentences until the matching call to pop."""
+        self.assumptions.append(
+            [self.encoder.literal(sentence) for sentence in sentences]
+        )
 
-    # Check that knowledge entails query
-    return check_all(knowledge, query, symbols, dict())
+    def pop(self):
+        """Drops the sentences assumed by the last call to push."""
+        self.assumptions.pop()
+
+    def assumed(self):
+        """Returns the literals of every sentence currently assumed."""
+        return [literal for frame in self.assumptions for literal in frame]
+
+    def satisfiable(self):
+        """Checks if the knowledge base and its assumptions can be true."""
+        return self.encoder.solver.solve(self.assumed())
+
+    def entails(self, query):
+        """Checks if the knowledge base and its assumptions entail query."""
+        negation = -self.encoder.literal(query)
+        return not self.encoder.solver.solve(self.assumed() + [negation])
+
+
+class Encoder():
+    """
+    Converts sentences to clauses for a Solver by the Tseitin
+    transformation: each compound sub-sentence gets a variable of its own,
+    with clauses making it equivalent to its parts.
+    """
+
+    def __init__(self, solver=None):
+        self.solver = Solver() if solver is None else solver
+
+        # Maps symbol names and compound sentences to solver variables
+        self.variables = dict()
+
+        # Variable that is always true, for empty conjunctions and
+        # (negated) disjunctions
+        self.true = self.solver.new_variable()
+        self.solver.add_clause([self.true])
+
+    def add(self, sentence):
+        """Adds clauses requiring the sentence to be true."""
+        Sentence.validate(sentence)
+        if isinstance(sentence, And):
+            for conjunct in sentence.conjuncts:
+                self.add(conjunct)
+        elif isinstance(sentence, Or):
+            self.solver.add_clause(
+                [self.literal(disjunct) for disjunct in sentence.disjuncts]
+            )
+        else:
+            self.solver.add_clause([self.literal(sentence)])
+
+    def literal(self, sentence):
+        """
+        Returns a solver literal that is true exactly when the sentence is,
+        adding the clauses that define it.
+        """
+        if isinstance(sentence, Symbol):
+            if sentence.name not in self.variables:
+                self.variables[sentence.name] = self.solver.new_variable()
+            return self.variables[sentence.name]
+        elif isinstance(sentence, Not):
+            return -self.literal(sentence.operand)
+        elif sentence in self.variables:
+            return self.variables[sentence]
+
+        elif isinstance(sentence, And) and not sentence.conjuncts:
+            return self.true
+        elif isinstance(sentence, Or) and not sentence.disjuncts:
+            return -self.true
+
+        add_clause = self.solver.add_clause
+        if isinstance(sentence, And):
+            parts = [self.literal(part) for part in sentence.conjuncts]
+            x = self.solver.new_variable()
+            for part in parts:
+                add_clause([-x, part])
+            add_clause([x] + [-part for part in parts])
+        elif isinstance(sentence, Or):
+            parts = [self.literal(part) for part in sentence.disjuncts]
+            x = self.solver.new_variable()
+            for part in parts:
+                add_clause([x, -part])
+            add_clause([-x] + parts)
+        elif isinstance(sentence, Implication):
+            a = self.literal(sentence.antecedent)
+            b = self.literal(sentence.consequent)
+            x = self.solver.new_variable()
+            add_clause([-x, -a, b])
+            add_clause([x, a])
+            add_clause([x, -b])
+        elif isinstance(sentence, Biconditional):
+            a = self.literal(sentence.left)
+            b = self.literal(sentence.right)
+            x = self.solver.new_variable()
+            add_clause([-x, -a, b])
+            add_clause([-x, a, -b])
+            add_clause([x, a, b])
+            add_clause([x, -a, -b])
+        else:
+            raise TypeError(f"cannot encode {sentence}")
+
+        self.variables[sentence] = x
+        return x
+
+
+class Solver():
+    """
+    CDCL SAT solver. Variables are numbered from 1, and literals are
+    variables (true) or their negations (false). Unit propagation uses
+    two watched literals per clause, and each conflict adds a learned
+    first-UIP clause. Clauses, including learned ones, are kept between
+    calls to solve.
+    """
+
+    def __init__(self):
+        self.variables = 0
+        self.clauses = []
+
+        # Maps each literal to the clauses watching it (as indexes);
+        # the watched literals of a clause are its first two
+        self.watches = dict()
+
+        # Assignment: values, decision levels and reason clauses by
+        # variable, and the assigned literals in order
+        self.values = dict()
+        self.levels = dict()
+        self.reasons = dict()
+        self.trail = []
+        self.limits = []
+        self.head = 0
+
+        # Decision heuristic: conflict activity and last value by variable,
+        # and a heap of (-activity, variable) with an up-to-date entry for
+        # every unassigned variable (and stale entries, skipped when popped)
+        self.activity = dict()
+        self.increment = 1.0
+        self.phases = dict()
+        self.heap = []
+
+        # Whether the clauses alone are unsatisfiable
+        self.inconsistent = False
+
+        # Values of variables in the last model found
+        self.model = dict()
+
+    def new_variable(self):
+        """Returns a new variable."""
+        self.variables += 1
+        self.activity[self.variables] = 0.0
+        heapq.heappush(self.heap, (-0.0, self.variables))
+        return self.variables
+
+    def value(self, literal):
+        """Returns the value of a literal, or None if it is unassigned."""
+        value = self.values.get(abs(literal))
+        if value is None or literal > 0:
+            return value
+        return not value
+
+    def add_clause(self, literals):
+        """Adds a clause, i.e. a disjunction of literals."""
+        self.backtrack(0)
+        clause = []
+        for literal in literals:
+            value = self.value(literal)
+            if value is True or -literal in clause:
+                return
+            if value is None and literal not in clause:
+                clause.append(literal)
+
+        if not clause:
+            self.inconsistent = True
+        elif len(clause) == 1:
+            self.assign(clause[0], None)
+            if self.propagate() is not None:
+                self.inconsistent = True
+        else:
+            self.attach(clause)
+
+    def attach(self, clause):
+        """Stores a clause of at least two literals, and watches it."""
+        self.clauses.append(clause)
+        index = len(self.clauses) - 1
+        self.watches.setdefault(clause[0], []).append(index)
+        self.watches.setdefault(clause[1], []).append(index)
+        return index
+
+    def assign(self, literal, reason):
+        """Makes a literal true at the current decision level."""
+        variable = abs(literal)
+        self.values[variable] = literal > 0
+        self.levels[variable] = len(self.limits)
+        self.reasons[variable] = reason
+        self.trail.append(literal)
+
+    def backtrack(self, level):
+        """Undoes every assignment above a decision level."""
+        if len(self.limits) <= level:
+            return
+        start = self.limits[level]
+        for literal in self.trail[start:]:
+            variable = abs(literal)
+            self.phases[variable] = literal > 0
+            del self.values[variable]
+            heapq.heappush(self.heap, (-self.activity[variable], variable))
+        del self.trail[start:]
+        del self.limits[level:]
+        self.head = min(self.head, start)
+
+    def propagate(self):
+        """
+        Assigns every literal implied by unit clauses.
+        Returns the index of a clause made false, or None.
+        """
+        while self.head < len(self.trail):
+            false = -self.trail[self.head]
+            self.head += 1
+            watching = self.watches.get(false, [])
+            kept = []
+            for position, index in enumerate(watching):
+                clause = self.clauses[index]
+                if clause[0] == false:
+                    clause[0], clause[1] = clause[1], clause[0]
+
+                # Satisfied by the other watched literal
+                if self.value(clause[0]) is True:
+                    kept.append(index)
+                    continue
+
+                # Watch another literal that is not false, if any
+                for k in range(2, len(clause)):
+                    if self.value(clause[k]) is not False:
+                        clause[1], clause[k] = clause[k], clause[1]
+                        self.watches.setdefault(clause[1], []).append(index)
+                        break
+                else:
+                    kept.append(index)
+                    if self.value(clause[0]) is False:
+                        kept.extend(watching[position + 1:])
+                        self.watches[false] = kept
+                        return index
+                    self.assign(clause[0], index)
+            self.watches[false] = kept
+        return None
+
+    def analyze(self, conflict):
+        """
+        Returns (clause, level): the first-UIP clause learned from a
+        conflict, with its asserting literal first, and the decision level
+        to backtrack to.
+        """
+        level = len(self.limits)
+        learned = []
+        seen = set()
+        pending = 0
+        literal = None
+        clause = self.clauses[conflict]
+        position = len(self.trail) - 1
+
+        while True:
+            for other in clause:
+                variable = abs(other)
+                if other == literal or variable in seen:
+                    continue
+                if self.levels[variable] > 0:
+                    seen.add(variable)
+                    self.bump(variable)
+                    if self.levels[variable] == level:
+                        pending += 1
+                    else:
+                        learned.append(other)
+
+            # Resolve on the latest seen literal of this level
+            while abs(self.trail[position]) not in seen:
+                position -= 1
+            literal = self.trail[position]
+            position -= 1
+            pending -= 1
+            if pending == 0:
+                break
+            clause = self.clauses[self.reasons[abs(literal)]]
+
+        if not learned:
+            return [-literal], 0
+
+        # Watch the literal from the highest remaining level second
+        highest = max(
+            range(len(learned)), key=lambda i: self.levels[abs(learned[i])]
+        )
+        learned[0], learned[highest] = learned[highest], learned[0]
+        return [-literal] + learned, self.levels[abs(learned[0])]
+
+    def bump(self, variable):
+        """Raises the activity of a variable involved in a conflict."""
+        self.activity[variable] += self.increment
+        if self.activity[variable] > 1e100:
+            for other in self.activity:
+                self.activity[other] *= 1e-100
+            self.increment *= 1e-100
+            self.rebuild()
+        else:
+            heapq.heappush(self.heap, (-self.activity[variable], variable))
+            if len(self.heap) > 4 * self.variables:
+                self.rebuild()
+
+    def rebuild(self):
+        """Rebuilds the decision heap from the unassigned variables."""
+        self.heap = [
+            (-activity, variable)
+            for variable, activity in self.activity.items()
+            if variable not in self.values
+        ]
+        heapq.heapify(self.heap)
+
+    def decide(self):
+        """Returns the unassigned variable of highest activity, or None."""
+        while self.heap:
+            activity, variable = heapq.heappop(self.heap)
+            if (variable not in self.values
+                    and -activity == self.activity[variable]):
+                return variable
+        return None
+
+    def solve(self, assumptions=()):
+        """
+        Returns whether the clauses are satisfiable with every literal in
+        `assumptions` true. If so, the model found is stored in `model`.
+        """
+        if self.inconsistent:
+            return False
+        self.backtrack(0)
+
+        while True:
+            conflict = self.propagate()
+            if conflict is not None:
+                if not self.limits:
+                    self.inconsistent = True
+                    return False
+                clause, level = self.analyze(conflict)
+                self.backtrack(level)
+                if len(clause) == 1:
+                    self.assign(clause[0], None)
+                else:
+                    self.assign(clause[0], self.attach(clause))
+                self.increment /= 0.95
+                continue
+
+            # Decide the assumptions first, one per decision level
+            if len(self.limits) < len(assumptions):
+                literal = assumptions[len(self.limits)]
+                value = self.value(literal)
+                if value is False:
+                    self.backtrack(0)
+                    return False
+                self.limits.append(len(self.trail))
+                if value is None:
+                    self.assign(literal, None)
+                continue
+
+            variable = self.decide()
+            if variable is None:
+                self.model = dict(self.values)
+                self.backtrack(0)
+                return True
+            self.limits.append(len(self.trail))
+            phase = self.phases.get(variable, False)
+            self.assign(variable if phase else -variable, None)
@@ -1,18 +1,62 @@
+import multiprocessing
 import os
-import random
 import re
 import sys
+import zipfile
 import numpy
-import copy
+from collections import namedtuple
 
 DAMPING = 0.85
 SAMPLES = 10000
 
+# Number of random draws made at once while sampling
+BATCH = 65536
+
+# Number of independent chains run by parallel_sample_pagerank
+CHAINS = 8
+
+# Default limit on the samples taken in all by parallel_sample_pagerank
+# when sampling until an error is reached
+MAX_SAMPLES = 1000 * SAMPLES * CHAINS
+
+# Links in HTML pages, the start of a link that may continue past the
+# end of the text read so far, and the number of characters read at a time
+LINK = re.compile(r"<a\s+(?:[^>]*?)href=\"([^\"]*)\"")
+PARTIAL_LINK = re.compile(r"<a(?:\s[^>]*)?|<a\s+(?:[^>]*?)href=\"[^\"]*")
+CHUNK = 65536
+
+# Parsed links and ranks cached in a corpus directory by cached_pagerank
+CACHE = "pagerank.npz"
+CACHE_VERSION = 1
+
+# Iteration stops once the L1 distance between successive rank vectors
+# falls below this
+TOLERANCE = 1e-6
+
+# Graph sampled by parallel_sample_pagerank in each worker process
+worker_graph = None
+
+# Directory and page indexes used by crawl_graph in each worker process
+worker_directory = None
+worker_index = None
+
+# Pages in sorted order, with the links between them in CSR form: the pages
+# linked to by page i are pages[links[offsets[i]:offsets[i + 1]]]
+Graph = namedtuple("Graph", ["pages", "offsets", "links"])
+
+# Link-following transition matrix in CSR form: row i holds, for each page
+# in columns[offsets[i]:offsets[i + 1]] that links to page i, the
+# probability in values of following that link. Also records the rows
+# with any entries, and which pages are dangling (have no links)
+Matrix = namedtuple(
+    "Matrix", ["offsets", "columns", "values", "nonempty", "dangling"]
+)
+
 
 def main():
     if len(sys.argv) != 2:
         sys.exit("Usage: python pagerank.py corpus")
-    corpus = crawl(sys.argv[1])
+    corpus = crawl_graph(sys.argv[1])
     ranks = sample_pagerank(corpus, DAMPING, SAMPLES)
     print(f"PageRank Results from Sampling (n = {SAMPLES})")
     for page in sorted(ranks):
@@ -35,10 +79,8 @@ def crawl(directory):
     for filename in os.listdir(directory):
         if not filename.endswith(".html"):
             continue
-        with open(os.path.join(directory, filename)) as f:
-            contents = f.read()
-            links = re.findall(r"<a\s+(?:[^>]*?)href=\"([^\"]*)\"", contents)
-            pages[filename] = set(links) - {filename}
+        links = extract_links(os.path.join(directory, filename))
+        pages[filename] = links - {filename}
 
     # Only include links to other pages in the corpus
     for filename in pages:
@@ -50,6 +92,253 @@ def crawl(directory):
     return pages
 
 
+def cached_pagerank(directory, damping_factor, processes=None):
+    """
+    Return PageRank values for a directory of HTML pages, as from
+    iterate_pagerank, using the cache file in the directory.
+
+    If no page has changed since the cache was written, the cached ranks
+    are returned. Otherwise only new or modified pages (by mtime and size)
+    are parsed again, across a pool of `processes`, and iteration starts
+    from the cached ranks.
+    """
+    cache = read_cache(directory)
+    pages, stats, links = scan_pages(directory, cache, processes)
+    if (cache is not None and cache["damping"] == damping_factor
+            and pages == cache["pages"] and stats == cache["stats"]):
+        return dict(zip(pages, cache["ranks"]))
+
+    if len(pages) == 0:
+        return dict()
+    graph = pages_graph(pages, links)
+    if cache is not None:
+        previous = dict(zip(cache["pages"], cache["ranks"]))
+        start = numpy.array([previous.get(page, 0) for page in pages])
+        start = start / start.sum() if start.sum() else None
+    else:
+        start = None
+
+    ranks, _ = power_iteration(
+        transition_matrix(graph), damping_factor, uniform(graph), start
+    )
+    ranks = ranks.tolist()
+    write_cache(directory, pages, stats, links, damping_factor, ranks)
+    return dict(zip(pages, ranks))
+
+
+def load_graph(directory, processes=None):
+    """
+    Return the Graph of a directory of HTML pages, parsing only pages that
+    are new or modified since the directory's cache file was written,
+    and updating the cache file.
+    """
+    cache = read_cache(directory)
+    pages, stats, links = scan_pages(directory, cache, processes)
+    if cache is None or pages != cache["pages"] or stats != cache["stats"]:
+        write_cache(directory, pages, stats, links)
+    return pages_graph(pages, links)
+
+
+def scan_pages(directory, cache, processes=None):
+    """
+    Return (pages, stats, links) for a directory of HTML pages: the sorted
+    page names, the (mtime, size) of each, and the list of every link in
+    each, taken from `cache` for pages that have not changed and parsed
+    across a pool of `processes` for the others.
+    """
+    cached = dict()
+    if cache is not None:
+        for page, stat, page_links in zip(
+            cache["pages"], cache["stats"], cache["links"]
+        ):
+            cached[page] = (stat, page_links)
+
+    pages = sorted(
+        filename for filename in os.listdir(directory)
+        if filename.endswith(".html")
+    )
+    stats = []
+    links = []
+    changed = []
+    for i, page in enumerate(pages):
+        stat = os.stat(os.path.join(directory, page))
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if page in cached and cached[page][0] == stat:
+            links.append(cached[page][1])
+        else:
+            links.append(None)
+            changed.append(i)
+        stats.append(stat)
+
+    if changed:
+        parsed = parse_pages(
+            directory, [pages[i] for i in changed], None, processes
+        )
+        for i, page_links in zip(changed, parsed):
+            links[i] = page_links
+    return pages, stats, links
+
+
+def pages_graph(pages, links):
+    """
+    Return the Graph of sorted `pages`, given the list of
+    every link in each page.
+    """
+    index = {page: i for i, page in enumerate(pages)}
+    offsets = numpy.zeros(len(pages) + 1, dtype=numpy.int64)
+    targets = []
+    for i, page in enumerate(pages):
+        targets.extend(sorted(
+            index[link] for link in links[i]
+            if link != page and link in index
+        ))
+        offsets[i + 1] = len(targets)
+    return Graph(pages, offsets, numpy.array(targets, dtype=numpy.int64))
+
+
+def read_cache(directory):
+    """
+    Return the contents of a directory's cache file as a dictionary of
+    pages, stats, links, damping and ranks (see write_cache),
+    or None if there is no readable cache file of the current version.
+    """
+    try:
+        with numpy.load(os.path.join(directory, CACHE)) as data:
+            if int(data["version"]) != CACHE_VERSION:
+                return None
+            offsets = data["offsets"].tolist()
+            links = data["links"].tolist()
+            return {
+                "pages": data["pages"].tolist(),
+                "stats": [tuple(stat) for stat in data["stats"].tolist()],
+                "links": [
+                    links[offsets[i]:offsets[i + 1]]
+                    for i in range(len(offsets) - 1)
+                ],
+                "damping": float(data["damping"]),
+                "ranks": data["ranks"].tolist()
+            }
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def write_cache(directory, pages, stats, links, damping_factor=None,
+                ranks=None):
+    """
+    Write a directory's cache file, holding its sorted `pages`, their
+    (mtime, size) `stats` and lists of `links`, and optionally their
+    `ranks` for `damping_factor`. Failing to write it is not an error.
+    """
+    offsets = numpy.zeros(len(pages) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(page_links) for page_links in links], out=offsets[1:])
+    path = os.path.join(directory, CACHE)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            numpy.savez(
+                f,
+                version=CACHE_VERSION,
+                pages=numpy.array(pages, dtype=str),
+                stats=numpy.array(stats, dtype=numpy.int64).reshape(-1, 2),
+                offsets=offsets,
+                links=numpy.array(
+                    [link for page_links in links for link in page_links],
+                    dtype=str
+                ),
+                damping=numpy.nan if ranks is None else damping_factor,
+                ranks=numpy.array([] if ranks is None else ranks)
+            )
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def crawl_graph(directory, processes=None):
+    """
+    Parse a directory of HTML pages across a process pool and
+    return the Graph of links between them.
+
+    Page names are mapped to their index in sorted order before links are
+    sent back from the workers, and each page's links are appended to the
+    CSR arrays as its results arrive.
+    """
+    pages = sorted(
+        filename for filename in os.listdir(directory)
+        if filename.endswith(".html")
+    )
+    index = {page: i for i, page in enumerate(pages)}
+
+    offsets = numpy.zeros(len(pages) + 1, dtype=numpy.int64)
+    links = []
+    for i, targets in enumerate(
+        parse_pages(directory, pages, index, processes)
+    ):
+        links.extend(targets)
+        offsets[i + 1] = len(links)
+
+    return Graph(pages, offsets, numpy.array(links, dtype=numpy.int64))
+
+
+def parse_pages(directory, pages, index=None, processes=None):
+    """
+    Yield the links of each of `pages` in a directory, in order, parsing
+    them across a process pool: the sorted indexes in `index` of the other
+    pages each links to, or if `index` is None, every link it has, sorted.
+    """
+    with multiprocessing.Pool(
+        processes, init_crawler, (directory, index)
+    ) as pool:
+        yield from pool.imap(page_links, pages, chunksize=64)
+
+
+def init_crawler(directory, index):
+    """
+    Set the directory and page indexes used by page_links in a worker.
+    """
+    global worker_directory, worker_index
+    worker_directory = directory
+    worker_index = index
+
+
+def page_links(page):
+    """
+    Return the sorted indexes of the other corpus pages linked to by `page`,
+    or all its links by name if the worker has no page indexes.
+    """
+    links = extract_links(os.path.join(worker_directory, page))
+    if worker_index is None:
+        return sorted(links)
+    return sorted(
+        worker_index[link] for link in links
+        if link != page and link in worker_index
+    )
+
+
+def extract_links(path):
+    """
+    Return the set of pages linked to by an HTML file,
+    reading it CHUNK characters at a time.
+    """
+    links = set()
+    carry = ""
+    with open(path) as f:
+        while True:
+            chunk = f.read(CHUNK)
+            text = carry + chunk
+            end = 0
+            for match in LINK.finditer(text):
+                links.add(match.group(1))
+                end = match.end()
+            if not chunk:
+                return links
+
+            # Keep an unfinished link (or a trailing "<") for the next chunk
+            start = text.rfind("<a", end)
+            if start != -1 and PARTIAL_LINK.fullmatch(text, start):
+                carry = text[start:]
+            else:
+                carry = text[-1:]
+
+
 def transition_model(corpus, page, damping_factor):
     """
     Return a probability distribution over which page to visit next,
@@ -104,45 +393,116 @@ def sample_pagerank(corpus, damping_factor, n):
 
     Return a dictionary where keys are page names, and values are
     their estimated PageRank value (a value between 0 and 1). All
-    PageRank values should sum to 1.
-    """
-    
-    PageRank = dict()
-    keys = list(corpus.keys())
-    
-    #choosing a page at random at first
-    page = random.choice(keys)
-    
-    #dict to keep track of the number of times a page is viewed
-    pageClicked = dict()
-
-    #initializing all values to 0
-    for key in keys:
-        pageClicked[key] = 0
-
-
-    for i in range(SAMPLES):
-        #getting transition model for the page
-        sampleDistribution = transition_model(corpus,page,damping_factor)
-        
-        sampleProbabilities = list(sampleDistribution.values())
-        samplePages = list(sampleDistribution.keys())  
-         
-        #using numpy to select a page with given probabilities
-        choice = numpy.random.choice(samplePages,1,p=sampleProbabilities)    
-        
-        page = choice[0]
-        
-        #updating the values for viewed pages
-        for key in keys:
-            if page == key:
-                pageClicked[page] += 1
+    PageRank values should sum to 1. `corpus` may also be a Graph.
+    """
+    graph = as_graph(corpus)
+    rng = numpy.random.default_rng()
+    counts = sample_counts(graph, damping_factor, n, rng)
+    return dict(zip(graph.pages, (counts / n).tolist()))
 
-    #setting the pagerank on the basis of times a page is viewed
-    for key in keys:
-        PageRank[key] = pageClicked[key] / SAMPLES
 
-    return PageRank
+def sample_counts(graph, damping_factor, n, rng):
+    """
+    Return an array of how many of `n` samples visit each page of a Graph,
+    following a random surfer who starts on a page at random and
+    moves according to the transition model.
+
+    The transition model is a mix of two uniform choices (a link of the
+    current page, or any page), so each step takes O(1) time using the
+    CSR offsets instead of building a distribution. Random numbers are
+    drawn from the generator `rng` in batches of BATCH.
+    """
+    size = len(graph.pages)
+    offsets = graph.offsets.tolist()
+    links = graph.links.tolist()
+    counts = [0] * size
+
+    page = None
+    remaining = n
+    while remaining:
+        batch = min(remaining, BATCH)
+        follow = (rng.random(batch) < damping_factor).tolist()
+        choice = rng.random(batch).tolist()
+        jump = rng.integers(size, size=batch).tolist()
+
+        for i in range(batch):
+            if page is not None and follow[i]:
+                start = offsets[page]
+                end = offsets[page + 1]
+
+                # Dangling pages jump anywhere instead
+                if start != end:
+                    page = links[start + int(choice[i] * (end - start))]
+                    counts[page] += 1
+                    continue
+            page = jump[i]
+            counts[page] += 1
+
+        remaining -= batch
+
+    return numpy.array(counts)
+
+
+def parallel_sample_pagerank(corpus, damping_factor, n=SAMPLES,
+                             chains=CHAINS, error=None, max_samples=None,
+                             processes=None, seed=None):
+    """
+    Return (ranks, errors): PageRank values estimated by `chains`
+    independent random surfers run across a process pool, and the
+    standard error of each page's value, both as dictionaries keyed by page.
+
+    Each round, every chain takes `n` more samples with a seed of its own,
+    derived from `seed`. With no `error`, a single round is run; otherwise
+    rounds continue until every standard error is below `error`, or
+    until `max_samples` (by default MAX_SAMPLES) have been taken in all.
+    The standard error is estimated from the spread of the per-chain
+    values, so `chains` must be at least 2. `corpus` may also be a Graph.
+    """
+    if chains < 2:
+        raise ValueError("at least two chains are needed to estimate error")
+    if error is not None and max_samples is None:
+        max_samples = MAX_SAMPLES
+
+    graph = as_graph(corpus)
+    seeds = numpy.random.SeedSequence(seed)
+    counts = numpy.zeros((chains, len(graph.pages)))
+    samples = 0
+
+    with multiprocessing.Pool(processes, init_worker, (graph,)) as pool:
+        while True:
+            jobs = [
+                (damping_factor, n, child) for child in seeds.spawn(chains)
+            ]
+            counts += pool.map(sample_chain, jobs)
+            samples += n
+
+            estimates = counts / samples
+            errors = estimates.std(axis=0, ddof=1) / numpy.sqrt(chains)
+            if (error is None or errors.max() < error
+                    or (samples + n) * chains > max_samples):
+                break
+
+    ranks = counts.sum(axis=0) / (samples * chains)
+    return (dict(zip(graph.pages, ranks.tolist())),
+            dict(zip(graph.pages, errors.tolist())))
+
+
+def init_worker(graph):
+    """
+    Set the Graph sampled by sample_chain in a worker process.
+    """
+    global worker_graph
+    worker_graph = graph
+
+
+def sample_chain(job):
+    """
+    Return the visit counts of one chain of parallel_sample_pagerank,
+    given its (damping_factor, n, seed).
+    """
+    damping_factor, n, seed = job
+    rng = numpy.random.default_rng(seed)
+    return sample_counts(worker_graph, damping_factor, n, rng)
 
 
 def iterate_pagerank(corpus, damping_factor):
@@ -152,53 +512,203 @@ def iterate_pagerank(corpus, damping_factor):
 
     Return a dictionary where keys are page names, and values are
     their estimated PageRank value (a value between 0 and 1). All
-    PageRank values should sum to 1.
-    """
-    pageRank1 = dict()
-    pageRank2 = dict()
-    pages = list(corpus.keys())
-    NoOfPages = len(pages)
-
-    #initialize the pagerank to 1/N
-    for page in pages:
-        pageRank1[page] = 1 / NoOfPages
-
-    #add all the pages as links if a page has no links
-    for pg in pages:
-        if len(corpus[pg]) == 0:
-            for pg1 in pages:
-                corpus[pg].add(pg1)
-
-    stop = False
-
-    while not stop:
-        for page in pages:
-            firstPart = (1 - damping_factor) / NoOfPages
-            linkedTo = []
-            
-            #getting a list of all the incoming links to a page
-            for page1 in pages:
-                if page in corpus[page1]:
-                    linkedTo.append(page1)
-            ratio = 0.0
-
-            #summation of all the pages linked to the page
-            for link in linkedTo:
-                linksNumber = len(list(corpus[link]))
-                ratio += ((pageRank1[link]) / linksNumber)
-
-            pagerank = firstPart + (damping_factor * ratio)
-
-            pageRank2[page] = pagerank
-        
-        for page in pages:
-            if abs((pageRank2[page]) - (pageRank1[page])) < 0.001:
-                stop = True
-                
-        pageRank1 = copy.deepcopy(pageRank2)
-            
-    return pageRank2
+    PageRank values should sum to 1. `corpus` may also be a Graph.
+    """
+    graph = as_graph(corpus)
+    if len(graph.pages) == 0:
+        return dict()
+
+    ranks, _ = power_iteration(
+        transition_matrix(graph), damping_factor, uniform(graph)
+    )
+    return dict(zip(graph.pages, ranks.tolist()))
+
+
+def personalized_pagerank(graph, damping_factor, teleports):
+    """
+    Return a matrix of personalized PageRank values for a Graph, with one
+    column per column of the `teleports` matrix.
+
+    Each column of `teleports` gives, for every page of the graph, how
+    likely the surfer is to jump there instead of following a link (and
+    from dangling pages); it is normalized to sum to 1. All columns are
+    ranked together, one sparse matrix by dense matrix product per step.
+    """
+    teleports = numpy.asarray(teleports, dtype=float)
+    if teleports.ndim != 2 or len(teleports) != len(graph.pages):
+        raise ValueError("teleports must have one row per page")
+    totals = teleports.sum(axis=0)
+    if (totals <= 0).any():
+        raise ValueError("every teleport vector must have positive total")
+
+    ranks, _ = power_iteration(
+        transition_matrix(graph), damping_factor, teleports / totals
+    )
+    return ranks
+
+
+def seed_teleports(graph, seed_sets):
+    """
+    Return the teleports matrix for personalized_pagerank that jumps
+    uniformly to the pages of each set in `seed_sets`, one column per set.
+    """
+    index = {page: i for i, page in enumerate(graph.pages)}
+    teleports = numpy.zeros((len(graph.pages), len(seed_sets)))
+    for column, seeds in enumerate(seed_sets):
+        for page in seeds:
+            teleports[index[page], column] = 1 / len(seeds)
+    return teleports
+
+
+def update_pagerank(corpus, ranks, damping_factor, delta):
+    """
+    Return (corpus, ranks) for a corpus after a change, given its PageRank
+    values `ranks` from before the change, without modifying either.
+
+    `delta` is a dictionary that may contain any of:
+        * "add_pages": a set of pages to add, with no links yet,
+        * "remove_pages": a set of pages to remove, with links to them,
+        * "add_links": a set of (page, link) pairs to add,
+        * "remove_links": a set of (page, link) pairs to remove.
+
+    Iteration starts from the previous ranks, with any new page given
+    an equal share, so a small change converges in a few iterations.
+    """
+    corpus = apply_delta(corpus, delta)
+    graph = link_graph(corpus)
+    if len(graph.pages) == 0:
+        return corpus, dict()
 
+    size = len(graph.pages)
+    start = numpy.array([ranks.get(page, 1 / size) for page in graph.pages])
+    start /= start.sum()
+
+    updated, _ = power_iteration(
+        transition_matrix(graph), damping_factor, uniform(graph), start
+    )
+    return corpus, dict(zip(graph.pages, updated.tolist()))
+
+
+def apply_delta(corpus, delta):
+    """
+    Return a copy of `corpus` with the changes in `delta` made to it;
+    see update_pagerank.
+    """
+    removed = delta.get("remove_pages", set())
+    corpus = {
+        page: set(links) - removed
+        for page, links in corpus.items()
+        if page not in removed
+    }
+    for page in delta.get("add_pages", set()):
+        corpus.setdefault(page, set())
+    for page, link in delta.get("add_links", set()):
+        corpus.setdefault(page, set()).add(link)
+    for page, link in delta.get("remove_links", set()):
+        if page in corpus:
+            corpus[page].discard(link)
+    return corpus
+
+
+def as_graph(corpus):
+    """
+    Return a corpus dictionary as a Graph, or a Graph unchanged.
+    """
+    if isinstance(corpus, Graph):
+        return corpus
+    return link_graph(corpus)
+
+
+def link_graph(corpus):
+    """
+    Return the Graph of a corpus dictionary, ignoring links to pages
+    that are not in the corpus.
+    """
+    pages = sorted(corpus)
+    index = {page: i for i, page in enumerate(pages)}
+
+    offsets = numpy.zeros(len(pages) + 1, dtype=numpy.int64)
+    links = []
+    for i, page in enumerate(pages):
+        links.extend(sorted(
+            index[link] for link in corpus[page] if link in index
+        ))
+        offsets[i + 1] = len(links)
+
+    return Graph(pages, offsets, numpy.array(links, dtype=numpy.int64))
+
+
+def transition_matrix(graph):
+    """
+    Return the link-following Matrix of a Graph.
+    Each page's links are equally likely to be followed.
+    """
+    size = len(graph.offsets) - 1
+    counts = numpy.diff(graph.offsets)
+
+    # Group the links by the page they point to
+    sources = numpy.repeat(numpy.arange(size), counts)
+    order = numpy.argsort(graph.links, kind="stable")
+    columns = sources[order]
+    offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(graph.links, minlength=size), out=offsets[1:])
+
+    return Matrix(
+        offsets=offsets,
+        columns=columns,
+        values=1 / counts[columns],
+        nonempty=numpy.flatnonzero(numpy.diff(offsets)),
+        dangling=counts == 0
+    )
+
+
+def multiply(matrix, ranks):
+    """
+    Return the product of a Matrix and a vector, or a matrix with
+    one rank vector per column.
+    """
+    products = matrix.values.reshape((-1,) + (1,) * (ranks.ndim - 1))
+    products = products * ranks[matrix.columns]
+    result = numpy.zeros(ranks.shape)
+    if len(products):
+        result[matrix.nonempty] = numpy.add.reduceat(
+            products, matrix.offsets[matrix.nonempty], axis=0
+        )
+    return result
+
+
+def uniform(graph):
+    """
+    Return the distribution that chooses any page of a Graph equally.
+    """
+    size = len(graph.pages)
+    return numpy.full(size, 1 / size)
+
+
+def power_iteration(matrix, damping_factor, teleport, start=None,
+                    tolerance=TOLERANCE):
+    """
+    Return (ranks, iterations): the PageRank vector for a transition Matrix
+    and the number of iterations taken to find it by power iteration.
+
+    With probability `1 - damping_factor`, and from any dangling page, the
+    surfer jumps to a page drawn from `teleport`. Iteration starts from
+    `start` (by default `teleport`) and stops when the L1 change in ranks
+    is below `tolerance`. `teleport` and `start` may also be matrices with
+    one distribution per column, in which case each column is ranked.
+    """
+    ranks = teleport if start is None else start
+    iterations = 0
+    while True:
+        dangling = ranks[matrix.dangling].sum(axis=0)
+        followed = multiply(matrix, ranks) + dangling * teleport
+        updated = (damping_factor * followed
+                   + (1 - damping_factor) * teleport)
+        iterations += 1
+        change = numpy.abs(updated - ranks).sum(axis=0).max()
+        ranks = updated
+        if change < tolerance:
+            return ranks, iterations
 
 
 if __name__ == "__main__":